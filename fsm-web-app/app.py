@@ -1,57 +1,89 @@
+import os
+import sys
+
+# The fsm package lives next to this directory. Only the repository root is
+# added, so the only new top-level name is the package itself.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
 from fsm import FSM, State
-from flask import Flask, render_template, request, redirect, url_for
+from fsm.instrumentation import stats
+from jobs import JobManager, DONE, simulate_task, exact_task
+from store import open_store, VersionConflict
+from flask import Flask, render_template, request, redirect, url_for, jsonify
 app = Flask(__name__)
 
-finite_state_machines = {}
+if os.environ.get("FSM_STATS"):
+    stats.enable()
+
+# FSM_STORE_PATH points at an SQLite file shared by all worker processes,
+# without it the FSMs live in this process only.
+finite_state_machines = open_store(os.environ.get("FSM_STORE_PATH"))
+
+def expected_version(request):
+    # The edit page sends the version it was rendered from, so an edit made
+    # on a stale page fails instead of silently building on a newer machine.
+    version = request.form.get('version')
+    return int(version) if version else None
+
+def render_edit_page(fsm_name, fsm, version):
+    # version must be the one fsm was read or written as, so the next edit
+    # is checked against the machine the user is looking at.
+    return render_template('edit_fsm.html', fsm_name=fsm_name, fsm_image=fsm.render(),
+                           fsm_version=version)
 
 @app.route('/')
 def index():
-    return render_template('index.html', fsm_list=finite_state_machines)
+    return render_template('index.html', fsm_list=finite_state_machines.names())
 
 @app.route('/create_fsm', methods=['POST'])
 def create_fsm():
     fsm_name = request.form.get('fsm_name')
     start_state = request.form.get('start_state')
-    if fsm_name not in finite_state_machines:
+    if finite_state_machines.add(fsm_name, FSM(State(start_state), fsm_name)):
         print("Creating FSM: " + fsm_name)
-        finite_state_machines[fsm_name] = FSM(State(start_state), fsm_name)
     return redirect(url_for('index'))
 
 @app.route('/edit_fsm/<fsm_name>')
 def edit_fsm(fsm_name):
-    if fsm_name in finite_state_machines:
-        fsm = finite_state_machines.get(fsm_name)
-        fsm_image = fsm.visualize()
-        return render_template('edit_fsm.html', fsm_name=fsm_name, fsm_image=fsm_image)
+    fsm, version = finite_state_machines.get_versioned(fsm_name)
+    if fsm:
+        return render_edit_page(fsm_name, fsm, version)
     else:
         return "FSM not found."
 
 @app.route('/add_transition/<fsm_name>', methods=['POST'])
 def add_transition(fsm_name):
-    if fsm_name in finite_state_machines:
-        fsm = finite_state_machines.get(fsm_name)
-        source_state = request.form.get('source_state')
-        target_state = request.form.get('target_state')
-        probability = float(request.form.get('probability'))
-        transition_label = request.form.get('transition-label')
+    source_state = request.form.get('source_state')
+    target_state = request.form.get('target_state')
+    probability = float(request.form.get('probability'))
+    transition_label = request.form.get('transition-label')
+
+    def edit(fsm):
         fsm.add_state(State(source_state))
         fsm.add_state(State(target_state))
         fsm.add_transition(source_state, target_state, transition_label, probability)
-        fsm_image = fsm.visualize()
 
-        return render_template('edit_fsm.html', fsm_name=fsm_name, fsm_image=fsm_image)
+    try:
+        fsm, version = finite_state_machines.update(fsm_name, edit, expected_version(request))
+    except VersionConflict:
+        return "FSM was changed by another request, reload it and try again.", 409
+
+    if fsm:
+        return render_edit_page(fsm_name, fsm, version)
     else:
         return "FSM not found."
 
 @app.route('/mark_final_state/<fsm_name>', methods=['POST'])
 def mark_final_state(fsm_name):
-    if fsm_name in finite_state_machines:
-        fsm = finite_state_machines.get(fsm_name)
-        state_name = request.form.get('state_name')
-        fsm.mark_state_as_final(state_name)
-        fsm_image = fsm.visualize()
+    state_name = request.form.get('state_name')
+    try:
+        fsm, version = finite_state_machines.update(fsm_name, lambda fsm: fsm.mark_state_as_final(state_name),
+                                                    expected_version(request))
+    except VersionConflict:
+        return "FSM was changed by another request, reload it and try again.", 409
 
-        return render_template('edit_fsm.html', fsm_name=fsm_name, fsm_image=fsm_image)
+    if fsm:
+        return render_edit_page(fsm_name, fsm, version)
     else:
         return "FSM not found."
 
@@ -67,14 +99,108 @@ def superpose_fsm():
     if fsm1 and fsm2:
         superposed_fsm = fsm1.superpose(fsm2)
         print(superposed_fsm.format_as_string())
-        finite_state_machines[fsm_name1 + " x " + fsm_name2] = superposed_fsm
+        finite_state_machines.put(fsm_name1 + " x " + fsm_name2, superposed_fsm)
 
-        superposed_fsm_image = superposed_fsm.visualize()
+        superposed_fsm_image = superposed_fsm.render()
         return render_template('superpose_fsm.html', 
                 fsm_name1=fsm_name1, fsm_name2=fsm_name2, 
                     superposed_fsm_image=superposed_fsm_image)
     else:
         return "One or both FSMs not found."
 
+# Jobs, like stats and the render cache, live in this process only. With
+# several workers a job can only be polled on the worker that accepted it,
+# so the job endpoints need a single worker process (threads are fine).
+job_manager = JobManager()
+
+def superpose_task(fsm1, fsm2):
+    # The product reports how much of it has been explored, a cancelled
+    # job stops at the next report.
+    def task(job):
+        superposed_fsm = fsm1.superpose(fsm2, report=job.report)
+        finite_state_machines.put(fsm1.name + " x " + fsm2.name, superposed_fsm)
+        return {
+            "name": superposed_fsm.name,
+            "states": len(superposed_fsm.states),
+            "transitions": sum(len(x.transitions) for x in superposed_fsm.states.values()),
+        }
+
+    return task
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    # kind=superpose with fsm1 and fsm2, kind=simulate with fsm and trials,
+    # kind=exact with fsm. Identical requests on unchanged FSMs get the
+    # existing job and its result.
+    kind = request.form.get('kind')
+    if kind == 'superpose':
+        fsm1 = finite_state_machines.get(request.form.get('fsm1'))
+        fsm2 = finite_state_machines.get(request.form.get('fsm2'))
+        if not (fsm1 and fsm2):
+            return jsonify({"error": "One or both FSMs not found."}), 404
+        params = {"fsm1": fsm1.name, "fsm2": fsm2.name}
+        key = (kind, fsm1.name, fsm1.fingerprint(), fsm2.name, fsm2.fingerprint())
+        task = superpose_task(fsm1, fsm2)
+    elif kind in ('simulate', 'exact'):
+        fsm = finite_state_machines.get(request.form.get('fsm'))
+        if not fsm:
+            return jsonify({"error": "FSM not found."}), 404
+        if kind == 'simulate':
+            trials = int(request.form.get('trials', 10000))
+            params = {"fsm": fsm.name, "trials": trials}
+            key = (kind, fsm.fingerprint(), trials)
+            task = simulate_task(fsm, trials)
+        else:
+            params = {"fsm": fsm.name}
+            key = (kind, fsm.fingerprint())
+            task = exact_task(fsm)
+    else:
+        return jsonify({"error": "Unknown job kind: " + str(kind)}), 400
+
+    job = job_manager.submit(kind, params, key, task)
+    return jsonify(job.to_dict()), 202
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    return jsonify([job.to_dict() for job in job_manager.list()])
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found."}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found."}), 404
+    if job.status != DONE:
+        return jsonify(job.to_dict()), 409
+    return jsonify(job.result)
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found."}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    return jsonify(stats.to_dict())
+
+@app.route('/stats', methods=['POST'])
+def update_stats():
+    action = request.form.get('action')
+    if action == 'enable':
+        stats.enable()
+    elif action == 'disable':
+        stats.disable()
+    elif action == 'reset':
+        stats.reset()
+    return jsonify(stats.to_dict())
+
 if __name__ == '__main__':
     app.run(debug=True)
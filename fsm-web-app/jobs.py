@@ -0,0 +1,166 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from fsm.exact import exact_walk_outcomes
+from fsm.instrumentation import stats
+from fsm.sampling import BatchSampler
+
+MAX_WORKERS = 2
+# Finished jobs kept for polling and reuse, the oldest are dropped first.
+MAX_FINISHED_JOBS = 256
+PROGRESS_BATCH = 10000
+MAX_WALK_STEPS = 100000
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, job_id, kind, params, key):
+        self.id = job_id
+        self.kind = kind
+        self.params = params
+        self.key = key
+        self.status = PENDING
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.cancel_requested = False
+        self.future = None
+
+    def report(self, progress):
+        # Called by the running task, which stops at the next report once
+        # the job is cancelled.
+        if self.cancel_requested:
+            raise JobCancelled()
+        self.progress = progress
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "params": self.params,
+            "status": self.status,
+            "progress": self.progress,
+            "error": self.error,
+            "created": self.created,
+            "finished": self.finished,
+        }
+
+
+class JobManager:
+    def __init__(self, max_workers = MAX_WORKERS):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.jobs = OrderedDict()
+        self.jobs_by_key = {}
+        self.lock = threading.Lock()
+
+    def submit(self, kind, params, key, task):
+        # A job with the same key that is queued, running or done is reused
+        # instead of computing the same result again.
+        with self.lock:
+            job = self.jobs_by_key.get(key)
+            if job is not None and job.status in (PENDING, RUNNING, DONE):
+                stats.count("jobs.reused")
+                return job
+
+            # Random ids, so an id can't name a different job on another
+            # worker process or after a restart.
+            job = Job(uuid.uuid4().hex, kind, params, key)
+            self.jobs[job.id] = job
+            self.jobs_by_key[key] = job
+            self._drop_old_jobs()
+
+        stats.count("jobs.submitted")
+        job.future = self.pool.submit(self._run, job, task)
+        return job
+
+    def _run(self, job, task):
+        if job.cancel_requested:
+            return
+
+        job.status = RUNNING
+        try:
+            with stats.timer("jobs." + job.kind):
+                result = task(job)
+        except JobCancelled:
+            job.status = CANCELLED
+        except Exception as e:
+            job.status = FAILED
+            job.error = str(e)
+        else:
+            job.result = result
+            job.progress = 1.0
+            job.status = DONE
+        job.finished = time.time()
+        stats.count("jobs." + job.status)
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def list(self):
+        # A copy, so the caller can iterate while jobs are submitted.
+        with self.lock:
+            return list(self.jobs.values())
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+
+        if job.status in (PENDING, RUNNING):
+            job.cancel_requested = True
+            if job.future is not None and job.future.cancel():
+                job.status = CANCELLED
+                job.finished = time.time()
+        return job
+
+    def _drop_old_jobs(self):
+        finished = [job for job in self.jobs.values() if job.status not in (PENDING, RUNNING)]
+        for job in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job.id]
+            if self.jobs_by_key.get(job.key) is job:
+                del self.jobs_by_key[job.key]
+
+
+def simulate_task(fsm, trials):
+    # Monte Carlo with the engine's batch sampler, one batch between two
+    # progress reports. Walks still going after MAX_WALK_STEPS (a cycle
+    # without a way out) are invalid.
+    def task(job):
+        sampler = BatchSampler(fsm.compile(), MAX_WALK_STEPS)
+        rng = np.random.default_rng()
+        counts = {}
+        invalid = 0
+        done = 0
+        while done < trials:
+            job.report(done / trials)
+            batch = min(PROGRESS_BATCH, trials - done)
+            invalid += sampler.sample_counts(batch, rng, counts)
+            done += batch
+
+        return {"trials": trials, "invalid": invalid, "counts": counts}
+
+    return task
+
+
+def exact_task(fsm):
+    # Probability of each Allen relation per walk. User FSMs may have
+    # cycles, mass still walking after MAX_WALK_STEPS counts as invalid.
+    def task(job):
+        relations, invalid, unclassified = exact_walk_outcomes(fsm, MAX_WALK_STEPS, job.report)
+        return {"relations": relations, "invalid": invalid, "unclassified": unclassified}
+
+    return task
@@ -0,0 +1,221 @@
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from fsm import FSM, State
+from fsm.instrumentation import stats
+
+# Attempts of an update that keeps losing the race to other writers.
+MAX_UPDATE_ATTEMPTS = 10
+LOADED_FSM_CACHE_SIZE = 64
+
+
+class VersionConflict(Exception):
+    pass
+
+
+def fsm_to_dict(fsm):
+    transitions = []
+    for state_label, state in fsm.states.items():
+        for symbol, next_state in state.transitions.items():
+            transitions.append([state_label, next_state.label, symbol, state.probabilities[symbol]])
+
+    return {
+        "name": fsm.name,
+        "start": fsm.start.label,
+        "states": list(fsm.states.keys()),
+        "transitions": transitions,
+        "final_states": sorted(fsm.final_states),
+    }
+
+
+def fsm_from_dict(data):
+    fsm = FSM(State(data["start"]), data["name"])
+    for label in data["states"]:
+        fsm.add_state(State(label))
+    for prev_state_label, next_state_label, symbol, probability in data["transitions"]:
+        fsm.add_transition(prev_state_label, next_state_label, symbol, probability)
+    for label in data["final_states"]:
+        fsm.mark_state_as_final(label)
+
+    return fsm
+
+
+def copy_fsm(fsm):
+    # Edits are made on a copy, so an FSM handed out by get() never changes
+    # under a request that is still reading it. The layout is kept for the
+    # incremental rendering.
+    copy = fsm_from_dict(fsm_to_dict(fsm))
+    copy.layout = fsm.layout
+    return copy
+
+
+class MemoryStore:
+    # FSMs of one process, guarded by a lock. Every change makes a new
+    # version of the machine.
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.fsms = {}
+
+    def names(self):
+        with self.lock:
+            return list(self.fsms.keys())
+
+    def get(self, name):
+        return self.get_versioned(name)[0]
+
+    def get_versioned(self, name):
+        # (fsm, version) read together, (None, None) if there is no such FSM.
+        with self.lock:
+            entry = self.fsms.get(name)
+            return (entry[1], entry[0]) if entry is not None else (None, None)
+
+    def version(self, name):
+        with self.lock:
+            entry = self.fsms.get(name)
+            return entry[0] if entry is not None else None
+
+    def add(self, name, fsm):
+        # False if an FSM with that name already exists.
+        with self.lock:
+            if name in self.fsms:
+                return False
+            self.fsms[name] = (1, fsm)
+            return True
+
+    def put(self, name, fsm, expected_version = None):
+        with self.lock:
+            version = self.version(name)
+            if expected_version is not None and version != expected_version:
+                raise VersionConflict(name)
+            self.fsms[name] = ((version or 0) + 1, fsm)
+            return (version or 0) + 1
+
+    def update(self, name, edit, expected_version = None):
+        # Applies edit to a copy of the FSM and stores it as the next
+        # version. Returns the new FSM and the version it was written as,
+        # (None, None) if there is no such FSM.
+        with self.lock:
+            entry = self.fsms.get(name)
+            if entry is None:
+                return (None, None)
+            if expected_version is not None and entry[0] != expected_version:
+                raise VersionConflict(name)
+
+            fsm = copy_fsm(entry[1])
+            edit(fsm)
+            self.fsms[name] = (entry[0] + 1, fsm)
+            return (fsm, entry[0] + 1)
+
+
+class SQLiteStore:
+    # FSMs as JSON rows of an SQLite database, shared by every worker
+    # process that opens the same file. Writes are compare-and-set on the
+    # version column, so concurrent edits retry instead of overwriting each
+    # other.
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.loaded = OrderedDict()
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS fsms "
+                           "(name TEXT PRIMARY KEY, version INTEGER NOT NULL, data TEXT NOT NULL)")
+        connection.commit()
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads.
+        if not hasattr(self.local, "connection"):
+            self.local.connection = sqlite3.connect(self.path, timeout=30)
+        return self.local.connection
+
+    def _row(self, name):
+        return self._connection().execute("SELECT version, data FROM fsms WHERE name = ?", (name,)).fetchone()
+
+    def _load(self, name, version, data):
+        # Parsed FSMs are cached per (name, version), a version never changes.
+        with self.lock:
+            fsm = self.loaded.get((name, version))
+            if fsm is not None:
+                self.loaded.move_to_end((name, version))
+                stats.count("store.cache_hits")
+                return fsm
+
+        fsm = fsm_from_dict(json.loads(data))
+        with self.lock:
+            self.loaded[(name, version)] = fsm
+            while len(self.loaded) > LOADED_FSM_CACHE_SIZE:
+                self.loaded.popitem(last=False)
+        return fsm
+
+    def names(self):
+        return [row[0] for row in self._connection().execute("SELECT name FROM fsms ORDER BY rowid")]
+
+    def get(self, name):
+        return self.get_versioned(name)[0]
+
+    def get_versioned(self, name):
+        row = self._row(name)
+        return (self._load(name, row[0], row[1]), row[0]) if row is not None else (None, None)
+
+    def version(self, name):
+        row = self._row(name)
+        return row[0] if row is not None else None
+
+    def add(self, name, fsm):
+        connection = self._connection()
+        try:
+            with connection:
+                connection.execute("INSERT INTO fsms (name, version, data) VALUES (?, 1, ?)",
+                                   (name, json.dumps(fsm_to_dict(fsm))))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def put(self, name, fsm, expected_version = None):
+        connection = self._connection()
+        data = json.dumps(fsm_to_dict(fsm))
+        # The version written, read inside the transaction that wrote it,
+        # since another writer may have moved it on right after the commit.
+        with connection:
+            if expected_version is None:
+                connection.execute("INSERT INTO fsms (name, version, data) VALUES (?, 1, ?) "
+                                   "ON CONFLICT(name) DO UPDATE SET version = version + 1, data = excluded.data",
+                                   (name, data))
+                return self._row(name)[0]
+
+            cursor = connection.execute("UPDATE fsms SET version = version + 1, data = ? "
+                                        "WHERE name = ? AND version = ?", (data, name, expected_version))
+            if cursor.rowcount == 0:
+                raise VersionConflict(name)
+        return expected_version + 1
+
+    def update(self, name, edit, expected_version = None):
+        for _ in range(MAX_UPDATE_ATTEMPTS):
+            row = self._row(name)
+            if row is None:
+                return (None, None)
+            if expected_version is not None and row[0] != expected_version:
+                raise VersionConflict(name)
+
+            fsm = copy_fsm(self._load(name, row[0], row[1]))
+            edit(fsm)
+            try:
+                self.put(name, fsm, row[0])
+            except VersionConflict:
+                stats.count("store.update_retries")
+                continue
+
+            with self.lock:
+                self.loaded[(name, row[0] + 1)] = fsm
+            return (fsm, row[0] + 1)
+
+        raise VersionConflict(name)
+
+
+def open_store(path = None):
+    # SQLite store at path, an in-memory one without.
+    if path:
+        return SQLiteStore(path)
+    return MemoryStore()
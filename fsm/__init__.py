@@ -0,0 +1,6 @@
+from .fsm import (FSM, State, adaptive_monte_carlo, get_clock_fsm, get_interval_fsm, monte_carlo)
+from .compiled import CompiledFSM
+from .clock import ClockedFSM
+from .lazy import LazyProduct
+from .exact import allen_path_counts, exact_allen_distribution
+from .instrumentation import stats
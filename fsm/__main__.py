@@ -0,0 +1,11 @@
+# The clock superposition experiment: python -m fsm
+from .fsm import FSM, get_clock_fsm, get_interval_fsm, monte_carlo
+from .exact import exact_allen_distribution
+
+fsm_1 = get_interval_fsm("a")
+fsm_2 = get_interval_fsm("b")
+
+clock_fsm = get_clock_fsm(25)
+clocked_fsm = FSM.superpose_many([fsm_1, fsm_2], clock=clock_fsm)
+monte_carlo(clocked_fsm, 500000)
+print(f"Exact probability of each relation: {exact_allen_distribution(clocked_fsm)}")
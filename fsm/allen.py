@@ -1,4 +1,6 @@
-from typing import List
+from typing import Iterable, List
+
+from .instrumentation import stats
 
 allowed_allen_transitions = [
     'la','lb','rb','ra', 
@@ -22,6 +24,7 @@ allen_mapping = {
 }
 
 def depad(path: List[str]):
+    stats.count("allen.depad_calls")
     ans = []
 
     for x in path:
@@ -33,19 +36,76 @@ def depad(path: List[str]):
 
     return ans
 
-def compute_allen_count(paths: List[List[str]]):
-    counts = {}
+class AllenClassifier:
+    # Recognises the Allen relations with a trie over depadded symbols.
+    # Every transition symbol maps to a digit once (0 for symbols depad
+    # drops), so classifying a path is one table lookup per symbol.
+    ROOT = 0
+    DEAD = 1
+
+    def __init__(self):
+        self.width = len(allowed_allen_transitions) + 1
+        self.next_node = []
+        self.relations = []
+        self._digits = {}
+        self._add_node()
+        self._add_node()
+
+        for key, relation in allen_mapping.items():
+            node = self.ROOT
+            for symbol in key.split("_"):
+                digit = allowed_allen_transitions.index(symbol) + 1
+                if self.step(node, digit) == self.DEAD:
+                    self.next_node[node * self.width + digit] = self._add_node()
+                node = self.step(node, digit)
+            self.relations[node] = relation
+
+    def _add_node(self) -> int:
+        node = len(self.relations)
+        self.relations.append(None)
+        self.next_node.extend([self.DEAD] * self.width)
+        self.next_node[node * self.width] = node
+        return node
+
+    def digit(self, symbol: str) -> int:
+        if symbol not in self._digits:
+            depadded = depad([symbol])
+            self._digits[symbol] = allowed_allen_transitions.index(depadded[0]) + 1 if depadded else 0
+        return self._digits[symbol]
+
+    def digits(self, symbols: List[str]) -> List[int]:
+        return [self.digit(symbol) for symbol in symbols]
 
-    for path in paths:
-        dpd = depad(path)
-        key = "_".join(dpd)
+    def step(self, node: int, digit: int) -> int:
+        return self.next_node[node * self.width + digit]
+
+    def relation(self, node: int):
+        return self.relations[node]
+
+    def classify(self, path: List[str]):
+        node = self.ROOT
+        for symbol in path:
+            node = self.next_node[node * self.width + self.digit(symbol)]
+        return self.relations[node]
+
+
+default_classifier = AllenClassifier()
+
+
+def compute_allen_count(paths: Iterable[List[str]]):
+    counts = {}
+    path_count = 0
 
-        if key in allen_mapping:
-            key = allen_mapping[key]
+    with stats.timer("classification"):
+        for path in paths:
+            key = default_classifier.classify(path)
+            path_count += 1
 
-            if key in counts:
-                counts[key]+=1
-            else:
-                counts[key] = 1
+            if key is not None:
+                if key in counts:
+                    counts[key]+=1
+                else:
+                    counts[key] = 1
 
-    return counts
\ No newline at end of file
+    stats.count("allen.paths_classified", path_count)
+    return counts
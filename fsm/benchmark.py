@@ -0,0 +1,269 @@
+import argparse
+import gc
+import json
+import math
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+
+from . import fsm as engine
+from . import rendering
+
+from .allen import compute_allen_count
+from .exact import exact_allen_distribution
+from .sampling import batch_allen_count
+
+INTERVAL_NAMES = "abcdef"
+
+FULL_GRID = {
+    "intervals": [2, 3, 4, 5],
+    "clocks": [10, 100, 1000, 10000],
+    "trials": [10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7],
+}
+
+QUICK_GRID = {
+    "intervals": [2, 3],
+    "clocks": [10, 100],
+    "trials": [10 ** 4, 10 ** 5],
+}
+
+# Per-walk Python loops and path enumeration are far slower than the batch
+# engines, so they run on a capped number of trials / paths.
+SIMULATE_TRIALS = 10 ** 4
+MAX_ENUMERATED_PATHS = 10 ** 6
+
+# Monte Carlo on the symbolic clock builds no unrolled product, so it runs
+# at every clock of the grid, on this many walks.
+SYMBOLIC_CLOCK_TRIALS = 10 ** 5
+
+
+def build_intervals(interval_count):
+    return [engine.get_interval_fsm(name) for name in INTERVAL_NAMES[:interval_count]]
+
+
+def build_clocked(interval_count, clock):
+    # Same construction as the __main__ block of fsm.py, with the caches
+    # cleared so every run pays for the product.
+    engine.superpose_cache.clear()
+    engine.compile_cache.clear()
+    return engine.FSM.superpose_many(build_intervals(interval_count), clock=engine.get_clock_fsm(clock))
+
+
+def measure(run, repeat):
+    # Best wall time over `repeat` runs, then one extra run under tracemalloc
+    # for the peak Python allocation.
+    best = math.inf
+    result = None
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        result = run()
+        best = min(best, time.perf_counter() - started)
+
+    gc.collect()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return best, peak, result
+
+
+def scenarios(grid, max_states):
+    for interval_count in grid["intervals"]:
+        for clock in grid["clocks"]:
+            if 3 ** interval_count * clock > max_states:
+                continue
+
+            yield ("superpose", {"intervals": interval_count, "clock": clock})
+            yield ("compile", {"intervals": interval_count, "clock": clock})
+            yield ("exact", {"intervals": interval_count, "clock": clock})
+            yield ("simulate_scan", {"intervals": interval_count, "clock": clock, "trials": SIMULATE_TRIALS})
+            yield ("simulate_alias", {"intervals": interval_count, "clock": clock, "trials": SIMULATE_TRIALS})
+            yield ("allen_count", {"intervals": interval_count, "clock": clock, "trials": SIMULATE_TRIALS})
+            yield ("paths", {"intervals": interval_count, "clock": clock})
+            for trials in grid["trials"]:
+                yield ("monte_carlo", {"intervals": interval_count, "clock": clock, "trials": trials})
+
+        for clock in grid["clocks"]:
+            yield ("symbolic_clock_exact", {"intervals": interval_count, "clock": clock})
+            yield ("symbolic_clock_monte_carlo", {"intervals": interval_count, "clock": clock,
+                                                  "trials": SYMBOLIC_CLOCK_TRIALS})
+
+        yield ("visualize", {"intervals": interval_count, "clock": None})
+
+
+def run_scenario(name, params, repeat):
+    interval_count, clock = params["intervals"], params["clock"]
+
+    if name == "superpose":
+        seconds, peak, clocked = measure(lambda: build_clocked(interval_count, clock), repeat)
+        return seconds, peak, len(clocked.states), "states"
+
+    if name == "symbolic_clock_exact":
+        intervals = engine.FSM.superpose_many(build_intervals(interval_count))
+        seconds, peak, _ = measure(lambda: exact_allen_distribution(intervals.with_clock(clock)), repeat)
+        return seconds, peak, 1, "runs"
+
+    if name == "symbolic_clock_monte_carlo":
+        compiled = engine.FSM.superpose_many(build_intervals(interval_count)).with_clock(clock).compile()
+        trials = params["trials"]
+        seconds, peak, _ = measure(lambda: batch_allen_count(compiled, trials, seed=0), repeat)
+        return seconds, peak, trials, "walks"
+
+    if name == "visualize":
+        product = engine.FSM.superpose_many(build_intervals(interval_count))
+
+        def render():
+            rendering.render_cache.clear()
+            product.layout = None
+            return rendering.render_png(product)
+
+        # Drawing needs networkx, pygraphviz and matplotlib, which are
+        # optional.
+        try:
+            seconds, peak, _ = measure(render, repeat)
+        except ImportError:
+            return None
+        return seconds, peak, len(product.states), "states"
+
+    clocked = build_clocked(interval_count, clock)
+
+    if name == "compile":
+        engine.compile_cache.clear()
+        seconds, peak, compiled = measure(lambda: engine.CompiledFSM.from_fsm(clocked), repeat)
+        return seconds, peak, compiled.transition_count(), "transitions"
+
+    if name == "exact":
+        seconds, peak, _ = measure(lambda: exact_allen_distribution(clocked), repeat)
+        return seconds, peak, len(clocked.states), "states"
+
+    if name in ("simulate_scan", "simulate_alias"):
+        backend = name.split("_")[1]
+        trials = params["trials"]
+        seconds, peak, _ = measure(lambda: [clocked.simulate(backend) for _ in range(trials)], repeat)
+        return seconds, peak, trials, "walks"
+
+    if name == "allen_count":
+        paths = [clocked.simulate()[0] for _ in range(params["trials"])]
+        seconds, peak, _ = measure(lambda: compute_allen_count(paths), repeat)
+        return seconds, peak, len(paths), "paths"
+
+    if name == "paths":
+        path_count = clocked.compile().count_paths()
+        if path_count > MAX_ENUMERATED_PATHS:
+            return None
+        seconds, peak, _ = measure(lambda: compute_allen_count(clocked.iter_paths_to_final_state()), repeat)
+        return seconds, peak, path_count, "paths"
+
+    if name == "monte_carlo":
+        compiled = clocked.compile()
+        trials = params["trials"]
+        seconds, peak, _ = measure(lambda: batch_allen_count(compiled, trials, seed=0), repeat)
+        return seconds, peak, trials, "walks"
+
+    raise Exception("Unknown benchmark: " + name)
+
+
+def scaling_exponents(results):
+    # Log-log slope of time against clock length per benchmark and interval
+    # count; ~1 means linear scaling in the clock.
+    series = {}
+    for result in results:
+        params = result["params"]
+        if params["clock"] is None or "monte_carlo" in result["benchmark"]:
+            continue
+        key = (result["benchmark"], params["intervals"])
+        series.setdefault(key, []).append((params["clock"], result["seconds"]))
+
+    exponents = {}
+    for (benchmark, interval_count), points in series.items():
+        points = sorted(point for point in points if point[1] > 0)
+        if len(points) < 2 or points[0][0] == points[-1][0]:
+            continue
+        slope = (math.log(points[-1][1]) - math.log(points[0][1])) / (math.log(points[-1][0]) - math.log(points[0][0]))
+        exponents[f"{benchmark}/{interval_count}"] = round(slope, 3)
+
+    return exponents
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(result):
+    return result["benchmark"] + " " + json.dumps(result["params"], sort_keys=True)
+
+
+def compare(baseline, results):
+    old = {result_key(result): result for result in baseline["results"]}
+    print(f"\nCompared with {baseline.get('commit')}:")
+    for result in results:
+        key = result_key(result)
+        if key in old:
+            ratio = result["seconds"] / old[key]["seconds"] if old[key]["seconds"] > 0 else math.inf
+            print(f"{key:70} {ratio:8.2f}x time")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for superpose, simulation, path enumeration and Allen classification")
+    parser.add_argument("--quick", action="store_true", help="small grid for a fast check")
+    parser.add_argument("--only", nargs="*", help="run only these benchmarks")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-states", type=int, default=500000,
+                        help="skip products with more than this many (estimated) states")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    grid = QUICK_GRID if args.quick else FULL_GRID
+
+    results = []
+    for name, params in scenarios(grid, args.max_states):
+        if args.only and name not in args.only:
+            continue
+
+        measured = run_scenario(name, params, args.repeat)
+        if measured is None:
+            continue
+
+        seconds, peak, items, unit = measured
+        result = {
+            "benchmark": name,
+            "params": params,
+            "seconds": seconds,
+            "throughput": items / seconds if seconds > 0 else math.inf,
+            "unit": unit + "/s",
+            "peak_memory_bytes": peak,
+        }
+        results.append(result)
+        print(f"{result_key(result):70} {seconds:10.4f}s {result['throughput']:14.1f} {result['unit']:14} "
+              f"{peak / 2 ** 20:8.1f} MiB")
+
+    report = {
+        "commit": current_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+        "scaling": scaling_exponents(results),
+    }
+    print(f"\nScaling exponents (time ~ clock^k): {report['scaling']}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
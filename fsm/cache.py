@@ -0,0 +1,70 @@
+import hashlib
+
+from collections import OrderedDict
+
+
+def fingerprint(fsm) -> str:
+    # Structural hash over the start state, every transition with its exact
+    # probability and the final states. Independent of insertion order.
+    digest = hashlib.sha256()
+    digest.update(repr(fsm.start.label).encode())
+
+    for label in sorted(fsm.states, key=repr):
+        state = fsm.states[label]
+        digest.update(b"\x00" + repr(label).encode())
+        for symbol in sorted(state.transitions):
+            transition = (symbol, state.transitions[symbol].label, state.probabilities[symbol])
+            digest.update(b"\x01" + repr(transition).encode())
+
+    for label in sorted(fsm.final_states, key=repr):
+        digest.update(b"\x02" + repr(label).encode())
+
+    return digest.hexdigest()
+
+
+class LRUCache:
+    # Bounded by the number of entries, or with sizeof by the sum of
+    # sizeof(value) over the entries. A value larger than maxsize on its own
+    # isn't kept and evicts nothing.
+    def __init__(self, maxsize = 32, sizeof = None):
+        self.maxsize = maxsize
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _sizeof(self, value):
+        return self.sizeof(value) if self.sizeof is not None else 1
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.remove(key)
+        size = self._sizeof(value)
+        if size > self.maxsize:
+            return
+
+        self.entries[key] = value
+        self.size += size
+        while self.size > self.maxsize:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= self._sizeof(evicted)
+
+    def remove(self, key):
+        if key in self.entries:
+            self.size -= self._sizeof(self.entries.pop(key))
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
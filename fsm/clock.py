@@ -0,0 +1,80 @@
+import random
+
+from array import array
+
+from .compiled import CompiledFSM
+
+
+def compile_clock_steps(interval_fsm):
+    # One clock tick of superpose(..., clock, is_clock=True) as a machine over
+    # the interval states alone: every state gets a 't' self-loop weighted by
+    # its stay probability, and every interval edge x becomes 'x,t'. Walks
+    # of at most `ticks` steps in it are the walks of the unrolled product.
+    labels = list(interval_fsm.states.keys())
+    state_ids = {label: i for i, label in enumerate(labels)}
+
+    symbols = []
+    symbol_ids = {}
+    offsets = array("q", [0])
+    targets = array("q")
+    edge_symbols = array("q")
+    probabilities = array("d")
+
+    for state_id, label in enumerate(labels):
+        state = interval_fsm.states[label]
+        edges = [("t", state_id, 1 - sum(state.probabilities.values()))]
+        for symbol, next_state in state.transitions.items():
+            edges.append((symbol + ",t", state_ids[next_state.label], state.probabilities[symbol]))
+
+        for symbol, target, probability in edges:
+            if symbol not in symbol_ids:
+                symbol_ids[symbol] = len(symbols)
+                symbols.append(symbol)
+
+            targets.append(target)
+            edge_symbols.append(symbol_ids[symbol])
+            probabilities.append(probability)
+        offsets.append(len(targets))
+
+    final = bytearray(len(labels))
+    for label in interval_fsm.final_states:
+        if label in state_ids:
+            final[state_ids[label]] = 1
+
+    return CompiledFSM(labels, symbols, state_ids[interval_fsm.start.label], offsets, targets,
+                       edge_symbols, probabilities, final)
+
+
+class ClockedFSM:
+    # Interval automaton composed with a clock of `count` states without
+    # unrolling it. The product state is (interval state, tick) and the tick
+    # is only the number of steps taken, so memory doesn't grow with count.
+    def __init__(self, interval_fsm, count):
+        if count < 2:
+            raise Exception("Too few states for clock")
+
+        self.step_fsm = compile_clock_steps(interval_fsm)
+        self.count = count
+        self.ticks = count - 1
+
+    @classmethod
+    def from_step_fsm(cls, step_fsm, count):
+        # For a step machine that is already compiled, e.g. one whose
+        # probabilities were rebound by a parameter sweep.
+        if count < 2:
+            raise Exception("Too few states for clock")
+
+        clocked_fsm = cls.__new__(cls)
+        clocked_fsm.step_fsm = step_fsm
+        clocked_fsm.count = count
+        clocked_fsm.ticks = count - 1
+        return clocked_fsm
+
+    def compile(self):
+        return self
+
+    def simulate_ids(self, rng = random):
+        return self.step_fsm.simulate_ids(rng, max_steps=self.ticks)
+
+    def simulate(self, rng = random):
+        return self.step_fsm.simulate(rng, max_steps=self.ticks)
@@ -0,0 +1,371 @@
+import json
+import mmap
+import random
+import struct
+import sys
+
+from array import array
+from bisect import bisect_left
+
+from .instrumentation import stats
+
+# Binary layout: header, then 8-byte aligned sections offsets, targets,
+# edge_symbols (int64), probabilities, cumulative (float64), final flags
+# (uint8) and the labels and symbols as JSON. Arrays are in native byte
+# order, recorded in the header.
+_MAGIC = b"FSMC"
+_FORMAT_VERSION = 1
+_HEADER = struct.Struct("<4sIc7xqqqqq")
+
+
+def _padded(size):
+    return (size + 7) // 8 * 8
+
+
+def _array(typecode, section):
+    values = array(typecode)
+    values.frombytes(section)
+    return values
+
+
+class CompiledFSM:
+    # Frozen, array backed form of an FSM. The outgoing edges of state i are
+    # offsets[i]:offsets[i + 1] in targets, symbols and probabilities (CSR).
+    __slots__ = ("labels", "symbols", "start", "offsets", "targets",
+                 "edge_symbols", "probabilities", "cumulative", "final", "_path", "_buffer")
+
+    def __init__(self, labels, symbols, start, offsets, targets, edge_symbols, probabilities, final,
+                 cumulative = None):
+        self.labels = labels
+        self.symbols = symbols
+        self.start = start
+        self.offsets = offsets
+        self.targets = targets
+        self.edge_symbols = edge_symbols
+        self.probabilities = probabilities
+        self.final = final
+        self.cumulative = cumulative if cumulative is not None else self._cumulative_probabilities()
+        self._path = None
+        self._buffer = None
+
+    def __reduce__(self):
+        # A memory-mapped machine is sent to other processes as its path, so
+        # each worker maps the same file instead of receiving a copy.
+        if self._path is not None:
+            return (CompiledFSM.load, (self._path,))
+
+        return (CompiledFSM, (self.labels, self.symbols, self.start, self.offsets, self.targets,
+                              self.edge_symbols, self.probabilities, self.final, self.cumulative))
+
+    @classmethod
+    def from_fsm(cls, fsm):
+        labels = list(fsm.states.keys())
+        state_ids = {label: i for i, label in enumerate(labels)}
+
+        symbols = []
+        symbol_ids = {}
+        offsets = array("q", [0])
+        targets = array("q")
+        edge_symbols = array("q")
+        probabilities = array("d")
+
+        for label in labels:
+            state = fsm.states[label]
+            for symbol, next_state in state.transitions.items():
+                if symbol not in symbol_ids:
+                    symbol_ids[symbol] = len(symbols)
+                    symbols.append(symbol)
+
+                targets.append(state_ids[next_state.label])
+                edge_symbols.append(symbol_ids[symbol])
+                probabilities.append(state.probabilities[symbol])
+            offsets.append(len(targets))
+
+        final = bytearray(len(labels))
+        for label in fsm.final_states:
+            if label in state_ids:
+                final[state_ids[label]] = 1
+
+        return cls(labels, symbols, state_ids[fsm.start.label], offsets, targets,
+                   edge_symbols, probabilities, final)
+
+    def _cumulative_probabilities(self):
+        cumulative = array("d", bytes(8 * len(self.probabilities)))
+
+        for state_id in range(len(self.labels)):
+            begin, end = self.offsets[state_id], self.offsets[state_id + 1]
+            sum_of_prob = sum(self.probabilities[begin:end])
+            if sum_of_prob <= 0:
+                continue
+
+            current_sum_of_prob = 0.0
+            for i in range(begin, end):
+                current_sum_of_prob += self.probabilities[i]
+                cumulative[i] = current_sum_of_prob / sum_of_prob
+
+        return cumulative
+
+    def state_count(self):
+        return len(self.labels)
+
+    def transition_count(self):
+        return len(self.targets)
+
+    def is_final(self, state_id):
+        return self.final[state_id] == 1
+
+    def simulate_ids(self, rng = random, max_steps = None):
+        state_id = self.start
+        path = []
+
+        while not self.final[state_id]:
+            begin, end = self.offsets[state_id], self.offsets[state_id + 1]
+            if begin == end or len(path) == max_steps:
+                return self._walk_result(path, True)
+
+            i = min(bisect_left(self.cumulative, rng.random(), begin, end), end - 1)
+            path.append(self.edge_symbols[i])
+            state_id = self.targets[i]
+
+        return self._walk_result(path, False)
+
+    def _walk_result(self, path, invalid):
+        stats.record_walk(path, invalid)
+        return (path, invalid)
+
+    def simulate(self, rng = random, max_steps = None):
+        path, invalid = self.simulate_ids(rng, max_steps)
+        return ([self.symbols[x] for x in path], invalid)
+
+    def topological_order(self, stop_at_final = False):
+        # Iterative DFS from the start state, so deep clocks don't hit the
+        # recursion limit. Only reachable states are ordered. With
+        # stop_at_final the edges leaving final states are ignored, as they
+        # are when simulating.
+        visited = bytearray(len(self.labels))
+        on_stack = bytearray(len(self.labels))
+        order = []
+
+        visited[self.start] = on_stack[self.start] = 1
+        stack = [(self.start, self.offsets[self.start])]
+        while len(stack) > 0:
+            state_id, i = stack[-1]
+            if i == self.offsets[state_id + 1] or (stop_at_final and self.final[state_id]):
+                stack.pop()
+                on_stack[state_id] = 0
+                order.append(state_id)
+                continue
+
+            stack[-1] = (state_id, i + 1)
+            next_state_id = self.targets[i]
+            if on_stack[next_state_id]:
+                raise Exception("FSM has a cycle through state " + str(self.labels[next_state_id]))
+            if not visited[next_state_id]:
+                visited[next_state_id] = on_stack[next_state_id] = 1
+                stack.append((next_state_id, self.offsets[next_state_id]))
+
+        order.reverse()
+        return order
+
+    def reachable_states(self):
+        # Forward from the start state. Walks stop at final states, so their
+        # outgoing edges are not followed.
+        reachable = bytearray(len(self.labels))
+        reachable[self.start] = 1
+        stack = [self.start]
+        while len(stack) > 0:
+            state_id = stack.pop()
+            if self.final[state_id]:
+                continue
+
+            for i in range(self.offsets[state_id], self.offsets[state_id + 1]):
+                if not reachable[self.targets[i]]:
+                    reachable[self.targets[i]] = 1
+                    stack.append(self.targets[i])
+
+        return reachable
+
+    def live_states(self):
+        # Backward from the final states: a state is live if some walk from
+        # it can still end in a final state.
+        predecessors = [[] for _ in range(len(self.labels))]
+        for state_id in range(len(self.labels)):
+            if not self.final[state_id]:
+                for i in range(self.offsets[state_id], self.offsets[state_id + 1]):
+                    predecessors[self.targets[i]].append(state_id)
+
+        live = bytearray(self.final)
+        stack = [state_id for state_id in range(len(self.labels)) if self.final[state_id]]
+        while len(stack) > 0:
+            state_id = stack.pop()
+            for previous in predecessors[state_id]:
+                if not live[previous]:
+                    live[previous] = 1
+                    stack.append(previous)
+
+        return live
+
+    def success_probabilities(self):
+        # Probability that a walk from each state ends in a final state
+        # rather than a dead end, by one pass in reverse topological order.
+        success = [0.0] * len(self.labels)
+        for state_id in reversed(self.topological_order(stop_at_final=True)):
+            if self.final[state_id]:
+                success[state_id] = 1.0
+                continue
+
+            begin, end = self.offsets[state_id], self.offsets[state_id + 1]
+            sum_of_prob = sum(self.probabilities[begin:end])
+            if sum_of_prob > 0:
+                success[state_id] = sum(self.probabilities[i] * success[self.targets[i]]
+                                        for i in range(begin, end)) / sum_of_prob
+
+        return success
+
+    def pruned(self, conditional = True):
+        # Drops unreachable states, states that can't reach a final state and
+        # the edges leaving final states, none of which a walk can use to
+        # finish. With conditional (needs an acyclic machine) every edge is
+        # reweighted by the success probability of its target, so walks
+        # follow exactly the distribution of the original valid walks and
+        # none are invalid. Without it the remaining edges keep their
+        # probabilities and simulate renormalises them locally.
+        keep = bytearray(a & b for a, b in zip(self.reachable_states(), self.live_states()))
+        success = None
+        if conditional:
+            # A final state can be structurally reachable only through zero
+            # probability edges, such states are dead for the walks too.
+            success = self.success_probabilities()
+            keep = bytearray(k if p > 0 else 0 for k, p in zip(keep, success))
+
+        if not keep[self.start]:
+            raise Exception("No final state is reachable from the start state")
+
+        state_ids = {}
+        for state_id in range(len(self.labels)):
+            if keep[state_id]:
+                state_ids[state_id] = len(state_ids)
+
+        offsets = array("q", [0])
+        targets = array("q")
+        edge_symbols = array("q")
+        probabilities = array("d")
+        final = bytearray(len(state_ids))
+
+        for state_id, new_state_id in state_ids.items():
+            final[new_state_id] = self.final[state_id]
+            if not self.final[state_id]:
+                begin, end = self.offsets[state_id], self.offsets[state_id + 1]
+                sum_of_prob = sum(self.probabilities[begin:end])
+
+                for i in range(begin, end):
+                    if not keep[self.targets[i]]:
+                        continue
+
+                    probability = self.probabilities[i]
+                    if conditional:
+                        probability = probability * success[self.targets[i]] / (sum_of_prob * success[state_id])
+                        if probability <= 0:
+                            continue
+
+                    targets.append(state_ids[self.targets[i]])
+                    edge_symbols.append(self.edge_symbols[i])
+                    probabilities.append(probability)
+            offsets.append(len(targets))
+
+        labels = [self.labels[state_id] for state_id in state_ids]
+        return CompiledFSM(labels, list(self.symbols), state_ids[self.start], offsets, targets,
+                           edge_symbols, probabilities, final)
+
+    def count_paths(self):
+        # Same paths as FSM.find_all_paths_to_final_state: every path from the
+        # start that ends in a final state, including ones passing through
+        # other final states on the way.
+        counts = [0] * len(self.labels)
+
+        for state_id in reversed(self.topological_order()):
+            count = self.final[state_id]
+            for i in range(self.offsets[state_id], self.offsets[state_id + 1]):
+                count += counts[self.targets[i]]
+            counts[state_id] = count
+
+        return counts[self.start]
+
+    def to_dict(self):
+        return {
+            "labels": list(self.labels),
+            "symbols": list(self.symbols),
+            "start": self.start,
+            "offsets": self.offsets.tolist(),
+            "targets": self.targets.tolist(),
+            "edge_symbols": self.edge_symbols.tolist(),
+            "probabilities": self.probabilities.tolist(),
+            "final": [i for i, x in enumerate(self.final) if x],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        final = bytearray(len(data["labels"]))
+        for state_id in data["final"]:
+            final[state_id] = 1
+
+        return cls(list(data["labels"]), list(data["symbols"]), data["start"],
+                   array("q", data["offsets"]), array("q", data["targets"]),
+                   array("q", data["edge_symbols"]), array("d", data["probabilities"]), final)
+
+    def save(self, path):
+        labels = json.dumps(list(self.labels)).encode()
+        symbols = json.dumps(list(self.symbols)).encode()
+        header = _HEADER.pack(_MAGIC, _FORMAT_VERSION, sys.byteorder[0].encode(), len(self.labels),
+                              len(self.targets), self.start, len(labels), len(symbols))
+
+        with open(path, "wb") as f:
+            f.write(header)
+            for section in (array("q", self.offsets), array("q", self.targets), array("q", self.edge_symbols),
+                            array("d", self.probabilities), array("d", self.cumulative),
+                            bytes(self.final), labels, symbols):
+                data = section.tobytes() if isinstance(section, array) else section
+                f.write(data + bytes(_padded(len(data)) - len(data)))
+
+    @classmethod
+    def load(cls, path, use_mmap = True):
+        # With use_mmap the arrays are memoryviews into a read-only mapping of
+        # the file, so loading copies nothing and processes share the pages.
+        with open(path, "rb") as f:
+            if use_mmap:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                buffer = f.read()
+
+        view = memoryview(buffer)
+        magic, version, byteorder, state_count, edge_count, start, labels_size, symbols_size = \
+            _HEADER.unpack_from(view)
+        if magic != _MAGIC or version != _FORMAT_VERSION:
+            raise Exception("Not a compiled FSM file: " + str(path))
+        if byteorder != sys.byteorder[0].encode():
+            raise Exception("Compiled FSM file has a different byte order: " + str(path))
+
+        position = _HEADER.size
+        sections = []
+        for size in ((state_count + 1) * 8, edge_count * 8, edge_count * 8, edge_count * 8,
+                     edge_count * 8, state_count, labels_size, symbols_size):
+            sections.append(view[position:position + size])
+            position += _padded(size)
+
+        offsets, targets, edge_symbols, probabilities, cumulative, final, labels, symbols = sections
+        if use_mmap:
+            offsets, targets, edge_symbols = offsets.cast("q"), targets.cast("q"), edge_symbols.cast("q")
+            probabilities, cumulative = probabilities.cast("d"), cumulative.cast("d")
+        else:
+            # Without a mapping the file was read anyway, so the sections are
+            # copied into arrays that pickle like a machine built in memory.
+            offsets, targets, edge_symbols = _array("q", offsets), _array("q", targets), _array("q", edge_symbols)
+            probabilities, cumulative = _array("d", probabilities), _array("d", cumulative)
+            final = bytearray(final)
+
+        compiled_fsm = cls(json.loads(labels.tobytes()), json.loads(symbols.tobytes()), start,
+                           offsets, targets, edge_symbols, probabilities, final, cumulative)
+        if use_mmap:
+            compiled_fsm._buffer = buffer
+            compiled_fsm._path = path
+        return compiled_fsm
@@ -0,0 +1,243 @@
+from .allen import default_classifier
+from .clock import ClockedFSM
+from .instrumentation import stats
+from .lazy import LazyProduct
+
+# States of the topological pass between two progress reports.
+_REPORT_EVERY = 1000
+
+
+def _as_compiled(fsm):
+    return fsm.compile() if hasattr(fsm, "compile") else fsm
+
+
+def exact_walk_outcomes(fsm, max_steps = None, report = None):
+    # Propagates probability mass per (state, classifier node) in one
+    # topological pass. Returns the relation probabilities, the mass of
+    # walks that end in a dead state (simulate's invalid) and the mass of
+    # valid walks that don't match any Allen relation. A machine with cycles
+    # needs max_steps: its mass is advanced one step at a time and what is
+    # still walking after max_steps counts as invalid. report, if given, is
+    # called now and then with the mass that has settled so far.
+    if isinstance(fsm, ClockedFSM):
+        return _clocked_walk_outcomes(fsm, report)
+    if isinstance(fsm, LazyProduct):
+        return _lazy_walk_outcomes(fsm, max_steps, report)
+
+    compiled_fsm = _as_compiled(fsm)
+    try:
+        order = compiled_fsm.topological_order(stop_at_final=True)
+    except Exception:
+        if max_steps is None:
+            raise
+        return _stepwise_walk_outcomes(compiled_fsm, max_steps, report)
+
+    classifier = default_classifier
+    digits = classifier.digits(compiled_fsm.symbols)
+    offsets, targets = compiled_fsm.offsets, compiled_fsm.targets
+    probabilities, edge_symbols = compiled_fsm.probabilities, compiled_fsm.edge_symbols
+
+    relations = {}
+    invalid = 0.0
+    unclassified = 0.0
+
+    mass = {compiled_fsm.start: {classifier.ROOT: 1.0}}
+    for i, state_id in enumerate(order):
+        if report is not None and i % _REPORT_EVERY == 0:
+            report(sum(relations.values()) + invalid + unclassified)
+
+        nodes = mass.pop(state_id, None)
+        if nodes is None:
+            continue
+
+        if compiled_fsm.final[state_id]:
+            for node, probability in nodes.items():
+                relation = classifier.relation(node)
+                if relation is not None:
+                    relations[relation] = relations.get(relation, 0.0) + probability
+                else:
+                    unclassified += probability
+            continue
+
+        begin, end = offsets[state_id], offsets[state_id + 1]
+        sum_of_prob = sum(probabilities[begin:end])
+        if begin == end or sum_of_prob <= 0:
+            invalid += sum(nodes.values())
+            continue
+
+        for i in range(begin, end):
+            share = probabilities[i] / sum_of_prob
+            digit = digits[edge_symbols[i]]
+            target = mass.setdefault(targets[i], {})
+
+            for node, probability in nodes.items():
+                node = classifier.step(node, digit)
+                target[node] = target.get(node, 0.0) + probability * share
+
+    return (relations, invalid, unclassified)
+
+
+def _clocked_walk_outcomes(clocked_fsm, report = None):
+    # Same result as on the unrolled product, but the mass is advanced one
+    # tick at a time over (interval state, classifier node), so memory
+    # doesn't depend on the clock length. Stops early once no mass is left.
+    step_fsm = clocked_fsm.step_fsm
+    classifier = default_classifier
+    digits = classifier.digits(step_fsm.symbols)
+    offsets, targets = step_fsm.offsets, step_fsm.targets
+    probabilities, edge_symbols = step_fsm.probabilities, step_fsm.edge_symbols
+
+    relations = {}
+    invalid = 0.0
+    unclassified = 0.0
+
+    mass = {(step_fsm.start, classifier.ROOT): 1.0}
+    for tick in range(clocked_fsm.ticks + 1):
+        if report is not None:
+            report(sum(relations.values()) + invalid + unclassified)
+        next_mass = {}
+
+        for (state_id, node), probability in mass.items():
+            if step_fsm.final[state_id]:
+                relation = classifier.relation(node)
+                if relation is not None:
+                    relations[relation] = relations.get(relation, 0.0) + probability
+                else:
+                    unclassified += probability
+                continue
+
+            begin, end = offsets[state_id], offsets[state_id + 1]
+            sum_of_prob = sum(probabilities[begin:end])
+            stuck = end - begin == 1 and targets[begin] == state_id
+            if tick == clocked_fsm.ticks or sum_of_prob <= 0 or stuck:
+                invalid += probability
+                continue
+
+            for i in range(begin, end):
+                if probabilities[i] == 0:
+                    continue
+
+                key = (targets[i], classifier.step(node, digits[edge_symbols[i]]))
+                next_mass[key] = next_mass.get(key, 0.0) + probability * probabilities[i] / sum_of_prob
+
+        mass = {key: probability for key, probability in next_mass.items() if probability > 0}
+        if len(mass) == 0:
+            break
+
+    return (relations, invalid, unclassified)
+
+
+def _lazy_walk_outcomes(lazy_product, max_steps = None, report = None):
+    # Only the current frontier is held besides the LRU table of the
+    # product.
+    return _stepwise_outcomes(lazy_product.start, lazy_product.is_final, lazy_product.moves, max_steps, report)
+
+
+def _stepwise_walk_outcomes(compiled_fsm, max_steps, report = None):
+    offsets, targets = compiled_fsm.offsets, compiled_fsm.targets
+    probabilities, edge_symbols = compiled_fsm.probabilities, compiled_fsm.edge_symbols
+
+    def is_final(state_id):
+        return compiled_fsm.final[state_id]
+
+    def moves(state_id):
+        begin, end = offsets[state_id], offsets[state_id + 1]
+        symbols = [compiled_fsm.symbols[symbol_id] for symbol_id in edge_symbols[begin:end]]
+        return (symbols, targets[begin:end], probabilities[begin:end], None)
+
+    return _stepwise_outcomes(compiled_fsm.start, is_final, moves, max_steps, report)
+
+
+def _stepwise_outcomes(start, is_final, moves, max_steps, report):
+    # Advances the mass one step at a time over (state, classifier node),
+    # which also works on machines with cycles. Mass still walking after
+    # max_steps counts as invalid.
+    classifier = default_classifier
+
+    relations = {}
+    invalid = 0.0
+    unclassified = 0.0
+
+    mass = {(start, classifier.ROOT): 1.0}
+    steps = 0
+    while len(mass) > 0:
+        if report is not None:
+            report(sum(relations.values()) + invalid + unclassified)
+        next_mass = {}
+
+        for (key, node), probability in mass.items():
+            if is_final(key):
+                relation = classifier.relation(node)
+                if relation is not None:
+                    relations[relation] = relations.get(relation, 0.0) + probability
+                else:
+                    unclassified += probability
+                continue
+
+            symbols, next_keys, probabilities, _ = moves(key)
+            sum_of_prob = sum(probabilities)
+            if len(symbols) == 0 or sum_of_prob <= 0 or steps == max_steps:
+                invalid += probability
+                continue
+
+            for symbol, next_key, edge_probability in zip(symbols, next_keys, probabilities):
+                if edge_probability == 0:
+                    continue
+
+                next_state = (next_key, classifier.step(node, classifier.digit(symbol)))
+                next_mass[next_state] = next_mass.get(next_state, 0.0) + probability * edge_probability / sum_of_prob
+
+        mass = next_mass
+        steps += 1
+
+    return (relations, invalid, unclassified)
+
+
+def exact_allen_distribution(fsm, conditional = False):
+    # Probability of each relation per trial, i.e. the expected value of
+    # compute_allen_count(...)[relation] / trials. With conditional the
+    # probabilities are normalised over classified walks, which is what
+    # count / total in monte_carlo estimates.
+    with stats.timer("exact"):
+        relations, _, _ = exact_walk_outcomes(fsm)
+
+    if conditional:
+        total = sum(relations.values())
+        if total > 0:
+            return {relation: probability / total for relation, probability in relations.items()}
+
+    return relations
+
+
+def allen_path_counts(fsm):
+    # Number of accepting paths per relation, equal to
+    # compute_allen_count(fsm.find_all_paths_to_final_state()) but counted
+    # per (state, classifier node) instead of enumerating the paths. Like the
+    # enumeration, paths continue past final states.
+    compiled_fsm = _as_compiled(fsm)
+    classifier = default_classifier
+    digits = classifier.digits(compiled_fsm.symbols)
+    offsets, targets, edge_symbols = compiled_fsm.offsets, compiled_fsm.targets, compiled_fsm.edge_symbols
+
+    counts = {}
+    paths = {compiled_fsm.start: {classifier.ROOT: 1}}
+    for state_id in compiled_fsm.topological_order():
+        nodes = paths.pop(state_id, None)
+        if nodes is None:
+            continue
+
+        if compiled_fsm.final[state_id]:
+            for node, count in nodes.items():
+                relation = classifier.relation(node)
+                if relation is not None:
+                    counts[relation] = counts.get(relation, 0) + count
+
+        for i in range(offsets[state_id], offsets[state_id + 1]):
+            digit = digits[edge_symbols[i]]
+            target = paths.setdefault(targets[i], {})
+
+            for node, count in nodes.items():
+                node = classifier.step(node, digit)
+                target[node] = target.get(node, 0) + count
+
+    return counts
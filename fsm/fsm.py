@@ -1,10 +1,39 @@
 import random
 import math
 
-from automata.fa.nfa import NFA
-from allen import compute_allen_count
-from typing import List
-from combinatorics import calculate_long_relation_count_superposed
+from typing import List, TYPE_CHECKING
+from .combinatorics import calculate_long_relation_count_superposed
+from .product import explore_product, is_product_final
+from .compiled import CompiledFSM
+from .clock import ClockedFSM
+from .lazy import LazyProduct
+from .lumping import lump
+from .exact import allen_path_counts
+from .cache import LRUCache, fingerprint
+from .instrumentation import stats
+from .rendering import render
+
+# automata (visualize), numpy (monte_carlo) and networkx/matplotlib (render)
+# are imported where they are used, so simulation and exact analysis start
+# without loading them.
+if TYPE_CHECKING:
+    from automata.fa.nfa import NFA
+
+# Both caches hold compiled machines and are bounded by their states plus
+# transitions, so a few huge products can't pin unbounded memory while many
+# small ones still fit. A superposed product is also compiled into both.
+CACHE_MAX_SIZE = 2000000
+
+# Product states explored between two progress reports of superpose.
+_REPORT_EVERY = 1000
+
+
+def _compiled_size(compiled_fsm):
+    return compiled_fsm.state_count() + compiled_fsm.transition_count()
+
+
+superpose_cache = LRUCache(CACHE_MAX_SIZE, _compiled_size)
+compile_cache = LRUCache(CACHE_MAX_SIZE, _compiled_size)
 
 def get_clock_fsm(count):
 
@@ -22,119 +51,237 @@ def get_clock_fsm(count):
 
     return clock_fsm
 
+def get_interval_fsm(name, start_probability = 0.5, end_probability = 0.5):
+    fsm = FSM(State("u_" + name))
+    fsm.add_state(State("li_" + name))
+    fsm.add_state(State("d_" + name))
+    fsm.mark_state_as_final("d_" + name)
+    fsm.add_transition("u_" + name, "li_" + name, "l" + name, start_probability)
+    fsm.add_transition("li_" + name, "d_" + name, "r" + name, end_probability)
+
+    return fsm
+
+def build_alias_table(probabilities):
+    # Vose's alias method: column i keeps itself with probability prob[i]
+    # and otherwise hands over to alias[i].
+    n = len(probabilities)
+    sum_of_prob = sum(probabilities)
+    scaled = [x * n / sum_of_prob for x in probabilities]
+
+    prob = [1.0] * n
+    alias = list(range(n))
+    small = [i for i, x in enumerate(scaled) if x < 1.0]
+    large = [i for i, x in enumerate(scaled) if x >= 1.0]
+
+    while len(small) > 0 and len(large) > 0:
+        less = small.pop()
+        more = large.pop()
+        prob[less] = scaled[less]
+        alias[less] = more
+        scaled[more] = scaled[more] + scaled[less] - 1.0
+
+        if scaled[more] < 1.0:
+            small.append(more)
+        else:
+            large.append(more)
+
+    return prob, alias
+
+
 class State:
     def __init__(self, label):
         self.label = label
         self.transitions = {}
         self.probabilities = {}
+        self._alias_table = None
     
     def add_transition(self, other, symbol, probability):
+        self._alias_table = None
         self.transitions[symbol] = other
         self.probabilities[symbol] = probability
 
+    def alias_table(self):
+        if self._alias_table is None:
+            symbols = list(self.probabilities.keys())
+            prob, alias = build_alias_table(list(self.probabilities.values()))
+            self._alias_table = (symbols, prob, alias)
+        return self._alias_table
+
 
 class FSM:
-    def __init__(self, start):
+    def __init__(self, start, name = None):
         self.start = start
+        self.name = name
         self.states = {}
         self.final_states = set()
         self.states[self.start.label] = self.start
         self.alphabet = set()
+        self.layout = None
+        self._fingerprint = None
 
     def add_state(self, state):
-        self.states[state.label] = state
+        if not state.label in self.states:
+            self._fingerprint = None
+            self.states[state.label] = state
 
     def mark_state_as_final(self, state_label):
+        if not state_label in self.states:
+            return
+
+        self._fingerprint = None
         self.final_states.add(state_label)
     
     def add_transition(self, prev_state_label, next_state_label, symbol: str, probability):
+        self._fingerprint = None
         self.alphabet.add(symbol)
         self.states[prev_state_label].add_transition(self.states[next_state_label], symbol, probability)
 
-    def find_all_paths_to_final_state(self):
-        ans = []
-        self._find_all_paths_to_final_state_helper(ans, [], self.start)
-        return ans
-
-    def _find_all_paths_to_final_state_helper(self, paths: List[List[str]], current_path: List[str], current_state: State):
-        if current_state.label in self.final_states:
-            paths.append(current_path.copy())
-
-        for symbol, next_state in current_state.transitions.items():
-            current_path.append(symbol)
-            self._find_all_paths_to_final_state_helper(paths, current_path, self.states[next_state.label])
-            current_path.pop(-1)
-
+    def fingerprint(self) -> str:
+        if self._fingerprint is None:
+            self._fingerprint = fingerprint(self)
+        return self._fingerprint
 
+    def find_all_paths_to_final_state(self):
+        return list(self.iter_paths_to_final_state())
+
+    def iter_paths_to_final_state(self):
+        current_path = []
+        if self.start.label in self.final_states:
+            yield current_path.copy()
+
+        stack = [iter(self.start.transitions.items())]
+        while len(stack) > 0:
+            for symbol, next_state in stack[-1]:
+                next_state = self.states[next_state.label]
+                current_path.append(symbol)
+                if next_state.label in self.final_states:
+                    yield current_path.copy()
+
+                stack.append(iter(next_state.transitions.items()))
+                break
+            else:
+                stack.pop()
+                if len(current_path) > 0:
+                    current_path.pop(-1)
+
+    def count_allen_paths(self):
+        return allen_path_counts(self.compile())
+
+    def superpose(self, other, is_clock = False, report = None):
+        # report, if given, is called now and then with the explored share
+        # of the product, measured against the product of the state counts.
+        return FSM._build_product([self, other], is_clock, report)
+
+    @staticmethod
+    def superpose_many(fsms, clock = None):
+        if clock is None:
+            return FSM._build_product(list(fsms), False)
+
+        return FSM._build_product(list(fsms) + [clock], True)
+
+    @staticmethod
+    def lazy_product(fsms, clock = None, maxsize = 100000) -> LazyProduct:
+        if clock is None:
+            return LazyProduct(fsms, False, maxsize)
+
+        return LazyProduct(list(fsms) + [clock], True, maxsize)
+
+    def with_clock(self, count) -> ClockedFSM:
+        return ClockedFSM(self, count)
+
+    @staticmethod
+    def _build_product(fsms, is_clock, report = None):
+        # The cache keeps the compiled product and every hit rebuilds an FSM
+        # from it, so callers can modify what they get without changing the
+        # cache. The names are part of the key because the product is named
+        # after its components.
+        key = (tuple((fsm.name, fsm.fingerprint()) for fsm in fsms), is_clock)
+        names = [fsm.name for fsm in fsms]
+        name = " x ".join(names) if None not in names else None
+
+        compiled_fsm = superpose_cache.get(key)
+        if compiled_fsm is not None:
+            stats.count("superpose.cache_hits")
+            return FSM.from_compiled(compiled_fsm, name)
+
+        with stats.timer("superpose"):
+            super_fsm = FSM._explore_product(fsms, is_clock, name, report)
+        superpose_cache.put(key, super_fsm.compile())
+        return super_fsm
 
-    def superpose(self, other, is_clock = False):
-        start_state = (State(self.start.label + "," + other.start.label), self.start.label, other.start.label)
-
-        super_fsm = FSM(start_state[0])
-
-        state_queue = []
-        state_queue.append(start_state)
-
-        while len(state_queue) > 0:
-            current_state = state_queue.pop(0)
-
-            fsm1_cur_state_label = current_state[1]
-            fsm2_cur_state_label = current_state[2]
-            super_fsm_label = current_state[0].label
-
-            if not is_clock:
-                for symbol, next_state in self.states[fsm1_cur_state_label].transitions.items():
-                    new_state = State(next_state.label+","+fsm2_cur_state_label)
-                    super_fsm.add_state(new_state)
-        
-                    if next_state.label in self.final_states and fsm2_cur_state_label in other.final_states:
-                        super_fsm.mark_state_as_final(new_state.label)
-
-                    probability_fsm1 = self.states[fsm1_cur_state_label].probabilities[symbol]
-                    probability_fsm2 = 1 - sum(
-                        [x[1] for x in other.states[fsm2_cur_state_label].probabilities.items()])
-                    probability = probability_fsm1 * probability_fsm2
+    @staticmethod
+    def _explore_product(fsms, is_clock, name = None, report = None):
+        start_key = tuple(fsm.start.label for fsm in fsms)
+        labels = {start_key: ",".join(start_key)}
+        super_fsm = FSM(State(labels[start_key]), name)
+        transition_count = 0
+        max_states = math.prod(len(fsm.states) for fsm in fsms)
+
+        for i, (key, moves) in enumerate(explore_product(fsms, is_clock)):
+            if report is not None and i % _REPORT_EVERY == 0:
+                report(i / max_states)
+            super_fsm_label = labels[key]
+
+            for symbol, next_key, probability in moves:
+                if next_key not in labels:
+                    labels[next_key] = ",".join(next_key)
+                    if labels[next_key] not in super_fsm.states:
+                        super_fsm.add_state(State(labels[next_key]))
+
+                if is_product_final(fsms, next_key, is_clock):
+                    super_fsm.mark_state_as_final(labels[next_key])
+
+                super_fsm.add_transition(super_fsm_label, labels[next_key], symbol, probability)
+                transition_count += 1
+
+        # Every transition beyond the first one into a state is a hit on an
+        # already created product state.
+        stats.count("superpose.states_created", len(labels))
+        stats.count("superpose.transitions_created", transition_count)
+        stats.count("superpose.duplicate_state_hits", transition_count - (len(labels) - 1))
+        return super_fsm
 
-                    super_fsm.add_transition(
-                        super_fsm_label, new_state.label, symbol, probability)
-                    state_queue.append((new_state, next_state.label, fsm2_cur_state_label))
 
-            for symbol, next_state in other.states[fsm2_cur_state_label].transitions.items():
-                new_state = State(fsm1_cur_state_label+","+next_state.label)
-                super_fsm.add_state(new_state)
-                if (is_clock and fsm1_cur_state_label in self.final_states):
-                    super_fsm.mark_state_as_final(new_state.label)
-                elif next_state.label in other.final_states and fsm1_cur_state_label in self.final_states:
-                    super_fsm.mark_state_as_final(new_state.label)
+    def save(self, path):
+        self.compile().save(path)
 
-                probability_fsm1 = 1 - sum(
-                    [x[1] for x in self.states[fsm1_cur_state_label].probabilities.items()])
-                probability_fsm2 = other.states[fsm2_cur_state_label].probabilities[symbol]
-                probability = probability_fsm1 * probability_fsm2
+    @staticmethod
+    def load(path):
+        return FSM.from_compiled(CompiledFSM.load(path, use_mmap=False))
 
-                super_fsm.add_transition(super_fsm_label, new_state.label, symbol, probability)
-                state_queue.append((new_state, fsm1_cur_state_label, next_state.label))
+    @staticmethod
+    def from_compiled(compiled_fsm, name = None):
+        fsm = FSM(State(compiled_fsm.labels[compiled_fsm.start]), name)
+        for label in compiled_fsm.labels:
+            if label not in fsm.states:
+                fsm.add_state(State(label))
 
+        for state_id, label in enumerate(compiled_fsm.labels):
+            for i in range(compiled_fsm.offsets[state_id], compiled_fsm.offsets[state_id + 1]):
+                fsm.add_transition(label, compiled_fsm.labels[compiled_fsm.targets[i]],
+                                   compiled_fsm.symbols[compiled_fsm.edge_symbols[i]],
+                                   compiled_fsm.probabilities[i])
 
-            for symbol_1, next_state_1 in self.states[fsm1_cur_state_label].transitions.items():
-                for symbol_2, next_state_2 in other.states[fsm2_cur_state_label].transitions.items():
-                    new_state = State(next_state_1.label+","+next_state_2.label)
-                    super_fsm.add_state(new_state)
-                    if is_clock and next_state_1.label in self.final_states:
-                        super_fsm.mark_state_as_final(new_state.label)
-                    elif next_state_1.label in self.final_states and next_state_2.label in other.final_states:
-                        super_fsm.mark_state_as_final(new_state.label)
+            if compiled_fsm.final[state_id]:
+                fsm.mark_state_as_final(label)
 
-                    probability_fsm1 = self.states[fsm1_cur_state_label].probabilities[symbol_1]
-                    probability_fsm2 = other.states[fsm2_cur_state_label].probabilities[symbol_2]
-                    probability = probability_fsm1 * probability_fsm2
+        return fsm
 
-                    super_fsm.add_transition(
-                        super_fsm_label, new_state.label, symbol_1 + "," + symbol_2, probability)
-                    state_queue.append((new_state, next_state_1.label, next_state_2.label))
+    def prune(self, conditional = True):
+        return FSM.from_compiled(self.compile().pruned(conditional))
 
-        return super_fsm
+    def lump(self):
+        return FSM.from_compiled(lump(self.compile()))
 
+    def compile(self) -> CompiledFSM:
+        compiled_fsm = compile_cache.get(self.fingerprint())
+        if compiled_fsm is None:
+            with stats.timer("compile"):
+                compiled_fsm = CompiledFSM.from_fsm(self)
+            compile_cache.put(self.fingerprint(), compiled_fsm)
+        else:
+            stats.count("compile.cache_hits")
+        return compiled_fsm
 
     def format_as_string(self)->str:
         string = f"State labels: {self.states.keys()}"
@@ -144,7 +291,23 @@ class FSM:
 
         return string
 
-    def visualize(self, add_prob = False) -> NFA:
+    def get_edge_labels(self):
+        result = {}
+        for state_label in self.states:
+            for symbol, next_state in self.states[state_label].transitions.items():
+                probability = self.states[state_label].probabilities[symbol]
+                result[(state_label, next_state.label)] = f"{symbol}, {probability:.2f}"
+
+        return result
+
+    def render(self):
+        # Data URI of a PNG, or of an SVG text listing for large machines.
+        with stats.timer("render"):
+            return render(self)
+
+    def visualize(self, add_prob = False) -> "NFA":
+        from automata.fa.nfa import NFA
+
         states = set(self.states.keys())
 
         transitions = {}
@@ -173,7 +336,10 @@ class FSM:
 
         return visual_dfa
 
-    def simulate(self):
+    def simulate(self, backend = "scan"):
+        if backend == "alias":
+            return self._simulate_alias()
+
         current_state = self.states[self.start.label]
         path = []
         invalid = False
@@ -200,46 +366,68 @@ class FSM:
             current_state = self.states[next_state_label]
             path.append(decision)
 
+        stats.record_walk(path, invalid)
+
+        return (path, invalid)
+
+    def _simulate_alias(self):
+        # Same distribution as the scan, but each step is one uniform draw
+        # (integer part picks the column, fraction the coin) and one lookup.
+        current_state = self.states[self.start.label]
+        path = []
+        invalid = False
+        while current_state.label not in self.final_states:
+
+            if len(current_state.transitions) <= 0:
+                invalid = True
+                break
+
+            symbols, prob, alias = current_state.alias_table()
+            x = random.random() * len(symbols)
+            i = int(x)
+            if x - i >= prob[i]:
+                i = alias[i]
+
+            decision = symbols[i]
+            current_state = self.states[current_state.transitions[decision].label]
+            path.append(decision)
+
+        stats.record_walk(path, invalid)
+
         return (path, invalid)
 
 
-def monte_carlo(clocked_intervals_fsm, trials = 100000):
-    trial_count = 0 
+def _sampled_fsm(clocked_intervals_fsm, prune):
+    # Pruning needs every product state, which a ClockedFSM (symbolic clock)
+    # and a LazyProduct don't build.
+    compiled_fsm = clocked_intervals_fsm.compile()
+    if prune:
+        if not isinstance(compiled_fsm, CompiledFSM):
+            raise Exception("prune needs a fully built product, not a " + type(compiled_fsm).__name__)
+        compiled_fsm = compiled_fsm.pruned()
 
-    paths = []
-    while trial_count < trials:
-        path, invalid = clocked_intervals_fsm.simulate()
+    return compiled_fsm
 
-        if not invalid:
-            paths.append(path)
-        
-        trial_count+=1
 
-    allen_count = compute_allen_count(paths)
+def monte_carlo(clocked_intervals_fsm, trials = 100000, seed = None, workers = 1, prune = False):
+    from .sampling import batch_allen_count, parallel_allen_count
+
+    compiled_fsm = _sampled_fsm(clocked_intervals_fsm, prune)
+    if workers > 1:
+        allen_count = parallel_allen_count(compiled_fsm, trials, seed, workers)
+    else:
+        allen_count = batch_allen_count(compiled_fsm, trials, seed)
     total_count = sum([x for x in allen_count.values()])
 
     print(f"Total count: {total_count}")
     print(f"Count of each relation: {allen_count}")
 
 
-if __name__ == "__main__":
-    start_1 = State("u_a")
-    fsm_1 = FSM(start_1)
-    fsm_1.add_state(State("li_a"))
-    fsm_1.add_state(State("d_a"))
-    fsm_1.mark_state_as_final("d_a")
-    fsm_1.add_transition("u_a", "li_a", "la", 0.5)
-    fsm_1.add_transition("li_a", "d_a", "ra", 0.5)
-
-    start_2 = State("u_b")
-    fsm_2 = FSM(start_2)
-    fsm_2.add_state(State("li_b"))
-    fsm_2.add_state(State("d_b"))
-    fsm_2.mark_state_as_final("d_b")
-    fsm_2.add_transition("u_b", "li_b", "lb", 0.5)
-    fsm_2.add_transition("li_b", "d_b", "rb", 0.5)
-
-    superpose_fsm = fsm_1.superpose(fsm_2)
-    clock_fsm = get_clock_fsm(25)
-    clocked_fsm = superpose_fsm.superpose(clock_fsm, is_clock=True)
-    monte_carlo(clocked_fsm, 500000)
+def adaptive_monte_carlo(clocked_intervals_fsm, precision = 0.001, confidence = 0.95,
+                         time_budget = None, seed = None, prune = False):
+    from .sampling import adaptive_allen_count
+
+    compiled_fsm = _sampled_fsm(clocked_intervals_fsm, prune)
+    return adaptive_allen_count(compiled_fsm, precision, confidence,
+                                time_budget=time_budget, seed=seed)
+
@@ -0,0 +1,97 @@
+import json
+import time
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _Timer:
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        timer = self.stats.timers.setdefault(self.name, {"calls": 0, "seconds": 0.0})
+        timer["calls"] += 1
+        timer["seconds"] += time.perf_counter() - self.started
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+class Stats:
+    # Opt-in counters and phase timers. Everything is a no-op until enable()
+    # is called, hot loops additionally check `enabled` before recording.
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.timers = {}
+        self.counters = {}
+        self.observations = {}
+
+    def timer(self, name):
+        if not self.enabled:
+            return _null_timer
+        return _Timer(self, name)
+
+    def count(self, name, amount = 1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, value):
+        if self.enabled:
+            observation = self.observations.setdefault(name, {"count": 0, "sum": 0, "min": value, "max": value})
+            observation["count"] += 1
+            observation["sum"] += value
+            observation["min"] = min(observation["min"], value)
+            observation["max"] = max(observation["max"], value)
+
+    def record_walk(self, path, invalid):
+        # One simulated walk: its length and whether it was invalid.
+        if self.enabled:
+            self.count("simulate.walks")
+            self.count("simulate.invalid_walks", invalid)
+            self.observe("simulate.walk_length", len(path))
+
+    def to_dict(self):
+        rates = {}
+        for name, walks in self.counters.items():
+            if name.endswith(".walks") and walks > 0:
+                prefix = name[:-len(".walks")]
+                rates[prefix + ".invalid_rate"] = self.counters.get(prefix + ".invalid_walks", 0) / walks
+
+        observations = {}
+        for name, observation in self.observations.items():
+            observations[name] = dict(observation, mean=observation["sum"] / observation["count"])
+
+        return {
+            "enabled": self.enabled,
+            "timers": {name: dict(timer) for name, timer in self.timers.items()},
+            "counters": dict(self.counters),
+            "observations": observations,
+            "rates": rates,
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+
+stats = Stats()
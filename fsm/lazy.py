@@ -0,0 +1,120 @@
+import random
+
+from bisect import bisect_left
+
+from .allen import default_classifier
+from .cache import LRUCache
+from .instrumentation import stats
+from .product import is_product_final, product_moves
+
+
+class LazyProduct:
+    # Product of component FSMs with the rules of superpose, but product
+    # states are only expanded when a walk or the exact analysis reaches
+    # them. Expanded states are kept in an LRU table of at most maxsize
+    # entries, so memory is bounded by maxsize instead of the product size.
+    def __init__(self, fsms, is_clock = False, maxsize = 100000):
+        self.fsms = list(fsms)
+        self.is_clock = is_clock
+        self.start = tuple(fsm.start.label for fsm in self.fsms)
+        self.table = LRUCache(maxsize)
+        self.options_cache = {}
+
+    def is_final(self, key):
+        return is_product_final(self.fsms, key, self.is_clock)
+
+    def moves(self, key):
+        # (symbols, next keys, probabilities, cumulative probabilities) of
+        # the product state, the same edges superpose would create for it.
+        entry = self.table.get(key)
+        if entry is None:
+            symbols, next_keys, probabilities = [], [], []
+            for symbol, next_key, probability in product_moves(self.fsms, key, self.is_clock, self.options_cache):
+                symbols.append(symbol)
+                next_keys.append(next_key)
+                probabilities.append(probability)
+
+            cumulative = []
+            sum_of_prob = sum(probabilities)
+            current_sum_of_prob = 0.0
+            for probability in probabilities:
+                current_sum_of_prob += probability
+                cumulative.append(current_sum_of_prob / sum_of_prob if sum_of_prob > 0 else 1.0)
+
+            entry = (symbols, next_keys, probabilities, cumulative)
+            self.table.put(key, entry)
+            stats.count("lazy.states_expanded")
+        return entry
+
+    def compile(self):
+        return self
+
+    def simulate(self, rng = random, max_steps = None):
+        key = self.start
+        path = []
+
+        while not self.is_final(key):
+            symbols, next_keys, _, cumulative = self.moves(key)
+            if len(symbols) == 0 or len(path) == max_steps:
+                return self._walk_result(path, True)
+
+            i = min(bisect_left(cumulative, rng.random()), len(symbols) - 1)
+            path.append(symbols[i])
+            key = next_keys[i]
+
+        return self._walk_result(path, False)
+
+    def _walk_result(self, path, invalid):
+        stats.record_walk(path, invalid)
+        return (path, invalid)
+
+    def allen_count(self, trials, seed = None, batch_size = 100000, rng = None):
+        # Same interface as BatchSampler, so the sampling helpers take
+        # either. Walks are sampled one at a time, batch_size is unused.
+        if rng is None:
+            import numpy as np
+            rng = np.random.default_rng(seed)
+
+        counts = {}
+        self.sample_counts(trials, rng, counts)
+        return counts
+
+    def sample_counts(self, trials, rng, counts):
+        # Adds the relation counts of `trials` walks to counts and returns
+        # the number of invalid walks among them. The walks draw from a
+        # random.Random seeded by the numpy generator, which is faster per
+        # draw. Walks carry their classifier node instead of the symbol
+        # list, like the batch sampler.
+        walk_rng = random.Random(int(rng.integers(2 ** 63)))
+        classifier = default_classifier
+        invalid_walks = 0
+
+        with stats.timer("sampling"):
+            for _ in range(trials):
+                key = self.start
+                node = classifier.ROOT
+                invalid = False
+
+                while not self.is_final(key):
+                    symbols, next_keys, _, cumulative = self.moves(key)
+                    if len(symbols) == 0:
+                        invalid = True
+                        break
+
+                    i = min(bisect_left(cumulative, walk_rng.random()), len(symbols) - 1)
+                    node = classifier.step(node, classifier.digit(symbols[i]))
+                    key = next_keys[i]
+
+                relation = classifier.relation(node)
+                if invalid:
+                    invalid_walks += 1
+                elif relation is not None:
+                    counts[relation] = counts.get(relation, 0) + 1
+
+        stats.count("lazy.walks", trials)
+        stats.count("lazy.invalid_walks", invalid_walks)
+        return invalid_walks
+
+    def __reduce__(self):
+        # Worker processes get the components and expand their own table.
+        return (LazyProduct, (self.fsms, self.is_clock, self.table.maxsize))
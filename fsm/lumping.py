@@ -0,0 +1,128 @@
+from array import array
+
+from .allen import default_classifier
+from .compiled import CompiledFSM
+from .instrumentation import stats
+
+# Probabilities are compared after rounding, so sums that differ only by
+# floating point noise still land in the same block.
+_PRECISION = 12
+
+
+def _signature(compiled_fsm, state_id, block, digits):
+    # Probability of moving into each (digit, block) pair. Edges leaving final
+    # states are never taken, so all final states share one signature.
+    if compiled_fsm.final[state_id]:
+        return None
+
+    begin, end = compiled_fsm.offsets[state_id], compiled_fsm.offsets[state_id + 1]
+    sum_of_prob = sum(compiled_fsm.probabilities[begin:end])
+    if sum_of_prob <= 0:
+        return ()
+
+    moves = {}
+    for i in range(begin, end):
+        move = (digits[compiled_fsm.edge_symbols[i]], block[compiled_fsm.targets[i]])
+        moves[move] = moves.get(move, 0.0) + compiled_fsm.probabilities[i] / sum_of_prob
+
+    return tuple(sorted((move, round(probability, _PRECISION)) for move, probability in moves.items()
+                        if probability > 0))
+
+
+def _acyclic_blocks(compiled_fsm, order, digits):
+    # Successors come before their predecessors in reversed topological
+    # order, so a single pass gives every state its final block.
+    block = {}
+    block_ids = {}
+    for state_id in reversed(order):
+        signature = _signature(compiled_fsm, state_id, block, digits)
+        block[state_id] = block_ids.setdefault(signature, len(block_ids))
+
+    return block
+
+
+def _refined_blocks(compiled_fsm, states, digits):
+    # Partition refinement for machines with cycles: split blocks by
+    # signature until the number of blocks stops growing.
+    block = {state_id: 0 if compiled_fsm.final[state_id] else 1 for state_id in states}
+    block_count = len(set(block.values()))
+
+    while True:
+        block_ids = {}
+        refined = {}
+        for state_id in states:
+            key = (block[state_id], _signature(compiled_fsm, state_id, block, digits))
+            refined[state_id] = block_ids.setdefault(key, len(block_ids))
+
+        block = refined
+        if len(block_ids) == block_count:
+            return block
+        block_count = len(block_ids)
+
+
+def lump(compiled_fsm, classifier = default_classifier):
+    # Quotient of the reachable part of the machine by probabilistic
+    # bisimulation, with symbols compared by their classifier digit (what
+    # remains of them after depad). Lumped states move into every block
+    # with the same probability per digit, so the distribution of Allen
+    # relations and of invalid walks is unchanged. Path counts are not:
+    # paths that only differ in lumped states become one path.
+    with stats.timer("lumping"):
+        digits = classifier.digits(compiled_fsm.symbols)
+        reachable = compiled_fsm.reachable_states()
+        states = [state_id for state_id in range(compiled_fsm.state_count()) if reachable[state_id]]
+
+        try:
+            order = compiled_fsm.topological_order(stop_at_final=True)
+        except Exception:
+            order = None
+
+        if order is not None:
+            block = _acyclic_blocks(compiled_fsm, order, digits)
+        else:
+            block = _refined_blocks(compiled_fsm, states, digits)
+
+        # Blocks are numbered by their first state and represented by it.
+        representatives = {}
+        for state_id in states:
+            representatives.setdefault(block[state_id], state_id)
+        new_ids = {old_block: i for i, old_block in enumerate(representatives)}
+
+        offsets = array("q", [0])
+        targets = array("q")
+        edge_symbols = array("q")
+        probabilities = array("d")
+        final = bytearray(len(representatives))
+
+        for old_block, state_id in representatives.items():
+            final[new_ids[old_block]] = compiled_fsm.final[state_id]
+            if not compiled_fsm.final[state_id]:
+                begin, end = compiled_fsm.offsets[state_id], compiled_fsm.offsets[state_id + 1]
+                sum_of_prob = sum(compiled_fsm.probabilities[begin:end])
+
+                # One edge per (digit, block), keeping the first symbol.
+                # Zero probability edges aren't part of the signatures and
+                # could point back into the same block, so they are dropped.
+                edges = {}
+                for i in range(begin, end):
+                    if compiled_fsm.probabilities[i] <= 0 or sum_of_prob <= 0:
+                        continue
+
+                    move = (digits[compiled_fsm.edge_symbols[i]], block[compiled_fsm.targets[i]])
+                    probability = compiled_fsm.probabilities[i] / sum_of_prob
+                    if move in edges:
+                        edges[move][1] += probability
+                    else:
+                        edges[move] = [compiled_fsm.edge_symbols[i], probability]
+
+                for (_, target_block), (symbol_id, probability) in edges.items():
+                    targets.append(new_ids[target_block])
+                    edge_symbols.append(symbol_id)
+                    probabilities.append(probability)
+            offsets.append(len(targets))
+
+        labels = [compiled_fsm.labels[state_id] for state_id in representatives.values()]
+
+    stats.count("lumping.states_removed", len(states) - len(labels))
+    return CompiledFSM(labels, list(compiled_fsm.symbols), new_ids[block[compiled_fsm.start]], offsets,
+                       targets, edge_symbols, probabilities, final)
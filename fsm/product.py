@@ -0,0 +1,76 @@
+from collections import deque
+from itertools import product
+
+
+def _component_options(fsm, label, can_stay):
+    state = fsm.states[label]
+    options = []
+
+    if can_stay:
+        options.append((None, label, 1 - sum(state.probabilities.values())))
+
+    for symbol, next_state in state.transitions.items():
+        options.append((symbol, next_state.label, state.probabilities[symbol]))
+
+    return options
+
+
+def product_choices(fsms, key, is_clock = False, options_cache = None):
+    # Every non-empty subset of the components may move in one step, the rest
+    # stay with probability 1 - sum(outgoing). With a clock (the last
+    # component) the clock has to tick on every step. Yields the symbol, the
+    # next key and the chosen (symbol, next label, probability) option of
+    # every component, symbol None meaning the component stays.
+    if options_cache is None:
+        options_cache = {}
+
+    last = len(fsms) - 1
+    per_component = []
+    for i, label in enumerate(key):
+        cache_key = (i, label)
+        if cache_key not in options_cache:
+            can_stay = not (is_clock and i == last)
+            options_cache[cache_key] = _component_options(fsms[i], label, can_stay)
+        per_component.append(options_cache[cache_key])
+
+    for choice in product(*per_component):
+        symbols = [option[0] for option in choice if option[0] is not None]
+        if len(symbols) == 0:
+            continue
+
+        yield (",".join(symbols), tuple(option[1] for option in choice), choice)
+
+
+def product_moves(fsms, key, is_clock = False, options_cache = None):
+    for symbol, next_key, choice in product_choices(fsms, key, is_clock, options_cache):
+        probability = 1.0
+        for option in choice:
+            probability *= option[2]
+
+        yield (symbol, next_key, probability)
+
+
+def is_product_final(fsms, key, is_clock = False):
+    interval_count = len(fsms) - 1 if is_clock else len(fsms)
+    return all(key[i] in fsms[i].final_states for i in range(interval_count))
+
+
+def explore_product(fsms, is_clock = False, moves_of = product_moves):
+    # moves_of may also be product_choices, the next key is the second item
+    # of either.
+    options_cache = {}
+    start_key = tuple(fsm.start.label for fsm in fsms)
+
+    visited = {start_key}
+    state_queue = deque([start_key])
+
+    while len(state_queue) > 0:
+        key = state_queue.popleft()
+        moves = list(moves_of(fsms, key, is_clock, options_cache))
+
+        for _, next_key, _ in moves:
+            if next_key not in visited:
+                visited.add(next_key)
+                state_queue.append(next_key)
+
+        yield key, moves
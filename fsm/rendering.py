@@ -0,0 +1,147 @@
+import base64
+import threading
+from io import BytesIO
+from html import escape
+from .cache import LRUCache
+from .instrumentation import stats
+
+# networkx, graphviz and matplotlib are imported by render_png only, they
+# take seconds to load and most users of the FSMs never draw one.
+
+RENDER_CACHE_SIZE = 64
+# Machines with more states than this are shown as a text listing instead
+# of a graph, a layout of a large product takes seconds and is unreadable.
+MAX_DRAWN_STATES = 60
+# At most this many new states are placed next to the old layout, more
+# than that gets a fresh graphviz layout.
+MAX_INCREMENTAL_STATES = 2
+LAYOUT_STEP = 72.0
+
+# The web app renders from several threads, the cache is only used under
+# render_lock. Rendering itself happens outside it.
+render_cache = LRUCache(RENDER_CACHE_SIZE)
+render_lock = threading.Lock()
+
+
+def render(fsm):
+    # Data URI of the rendered FSM. Keyed by the structural fingerprint, so
+    # a page reload or an unchanged FSM doesn't render again.
+    key = fsm.fingerprint()
+    with render_lock:
+        image = render_cache.get(key)
+    if image is not None:
+        stats.count("render.cache_hits")
+        return image
+
+    stats.count("render.cache_misses")
+    if len(fsm.states) > MAX_DRAWN_STATES:
+        stats.count("render.text_fallbacks")
+        image = render_text(fsm)
+    else:
+        image = render_png(fsm)
+
+    with render_lock:
+        render_cache.put(key, image)
+
+    return image
+
+
+def graph(fsm):
+    import networkx as nx
+
+    image = nx.DiGraph()
+    for state_label, state in fsm.states.items():
+        for next_state in state.transitions.values():
+            image.add_edge(state_label, next_state.label)
+    return image
+
+
+def layout(fsm, image):
+    # Reuses the positions of the previous render when only a few states
+    # were added, e.g. by a single add_transition, and places the new ones
+    # next to a neighbour.
+    from networkx.drawing.nx_agraph import graphviz_layout
+
+    previous = fsm.layout
+    if previous is not None:
+        new_nodes = [node for node in image.nodes if node not in previous]
+        if len(new_nodes) <= MAX_INCREMENTAL_STATES:
+            stats.count("render.layout_reuses")
+            pos = {node: previous[node] for node in image.nodes if node in previous}
+            for node in new_nodes:
+                pos[node] = _free_position(image, pos, node)
+            fsm.layout = pos
+            return pos
+
+    fsm.layout = graphviz_layout(image)
+    return fsm.layout
+
+
+def _free_position(image, pos, node):
+    neighbours = [x for x in list(image.predecessors(node)) + list(image.successors(node)) if x in pos]
+    if len(neighbours) > 0:
+        x, y = pos[neighbours[0]]
+    elif len(pos) > 0:
+        x, y = min(pos.values(), key=lambda p: p[1])
+    else:
+        return (0.0, 0.0)
+
+    # Step down and to the right until no other state is that close.
+    taken = set(pos.values())
+    while True:
+        x, y = x + LAYOUT_STEP / 2, y - LAYOUT_STEP
+        if all(abs(x - a) >= LAYOUT_STEP / 2 or abs(y - b) >= LAYOUT_STEP / 2 for a, b in taken):
+            return (x, y)
+
+
+def render_png(fsm):
+    import networkx as nx
+    from matplotlib.figure import Figure
+
+    with stats.timer("render.png"):
+        image = graph(fsm)
+        pos = layout(fsm, image)
+        node_colors = []
+        for node in image.nodes:
+            if node == fsm.start.label:
+                node_colors.append('green')
+            elif node in fsm.final_states:
+                node_colors.append('red')
+            else:
+                node_colors.append('skyblue')
+
+        # A Figure that isn't registered with pyplot is freed with its last
+        # reference, pyplot keeps every figure open until plt.close.
+        fig = Figure()
+        ax = fig.add_subplot()
+        nx.draw(image, pos, ax=ax, with_labels=True, node_size=400,
+                node_color=node_colors, font_size=8,
+                font_color='black', font_weight='bold', arrowsize=12)
+        nx.draw_networkx_edge_labels(
+            image, pos, ax=ax,
+            edge_labels=fsm.get_edge_labels(),
+            font_color='red'
+        )
+
+        img = BytesIO()
+        fig.savefig(img, format='png')
+        return "data:image/png;base64," + base64.b64encode(img.getvalue()).decode()
+
+
+def render_text(fsm):
+    # SVG with one line per state, no layout needed.
+    lines = [f"{len(fsm.states)} states, start {fsm.start.label}, final {sorted(fsm.final_states)}"]
+    for state_label, state in fsm.states.items():
+        transitions = [f"{symbol} ({state.probabilities[symbol]:.2f}) -> {next_state.label}"
+                       for symbol, next_state in state.transitions.items()]
+        lines.append(f"{state_label}: " + "; ".join(transitions))
+
+    line_height = 16
+    width = 8 * max(len(line) for line in lines) + 20
+    height = line_height * len(lines) + 20
+    svg = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-family="monospace" font-size="13">']
+    for i, line in enumerate(lines):
+        svg.append(f'<text x="10" y="{(i + 1) * line_height}">{escape(line)}</text>')
+    svg.append('</svg>')
+
+    return "data:image/svg+xml;base64," + base64.b64encode("\n".join(svg).encode()).decode()
@@ -0,0 +1,490 @@
+import os
+import time
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from statistics import NormalDist
+
+from .allen import allen_mapping, default_classifier
+from .clock import ClockedFSM
+from .instrumentation import stats
+from .lazy import LazyProduct
+
+_INVALID = -1
+_LINEAR_SCAN_MAX_DEGREE = 8
+
+# Machines whose (state, node) chain has more rows times width than this
+# are sampled on the compiled machine itself, the chain and its tables
+# would cost more than they save.
+_MAX_CHAIN_SIZE = 1 << 18
+# Walkers on the chain are advanced in chunks that stay in the CPU cache.
+_CHUNK_SIZE = 16384
+# Bounds of the tables that advance walkers several steps at once: columns
+# per row, entries per table and steps per draw.
+_MAX_ALIAS_WIDTH = 64
+_MAX_TABLE_SIZE = 1 << 20
+_MAX_STRIDE = 16
+
+
+def _merge_columns(probabilities, targets):
+    # One column per (row, target) with the summed probability, dropping
+    # columns without probability. Rows are padded to the widest with
+    # columns into the row itself that have no probability.
+    rows = len(probabilities)
+    row_ids = np.repeat(np.arange(rows), probabilities[0].size)
+    probabilities, targets = probabilities.ravel(), targets.ravel()
+    keep = probabilities > 0
+    keys = row_ids[keep] * rows + targets[keep]
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+
+    first = np.flatnonzero(np.diff(keys, prepend=-1))
+    merged_probabilities = np.add.reduceat(probabilities[keep][order], first)
+    merged_rows, merged_targets = np.divmod(keys[first], rows)
+
+    counts = np.bincount(merged_rows, minlength=rows)
+    columns = np.arange(len(first)) - np.repeat(np.cumsum(counts) - counts, counts)
+    padded_probabilities = np.zeros((rows, int(counts.max())))
+    padded_targets = np.repeat(np.arange(rows)[:, None], padded_probabilities.shape[1], axis=1)
+    padded_probabilities[merged_rows, columns] = merged_probabilities
+    padded_targets[merged_rows, columns] = merged_targets
+    return padded_probabilities, padded_targets
+
+
+class _AliasTable:
+    # Walker's alias method over the rows of the sampler's chain, width
+    # columns per row. A walker at row r is stored as r * width, so one
+    # draw x in [0, width) gives the column (r * width + int(x)), and x
+    # below the column's threshold takes its target, otherwise its alias.
+    def __init__(self, probabilities, targets, absorbing):
+        rows, width = probabilities.shape
+        # Walkers and targets are int32, and walk doubles the column index.
+        if rows * width * 2 >= 2 ** 31:
+            raise Exception("Alias table too large: " + str(rows) + " rows of " + str(width) + " columns")
+
+        # Columns sorted by probability, so the columns below 1 (after
+        # scaling by width) come first. Every round fills one column up to 1
+        # with mass from the largest column, which is the next column from
+        # the top once the current largest drops below 1 itself.
+        order = np.argsort(probabilities, axis=1)
+        scaled = (np.take_along_axis(probabilities, order, axis=1) * width).ravel()
+        targets = np.take_along_axis(targets, order, axis=1).ravel()
+        thresholds = np.ones(rows * width)
+        aliases = np.arange(rows * width)
+
+        base = np.arange(rows) * width
+        small = base.copy()
+        large = base + width - 1
+        for _ in range(width - 1):
+            large_is_small = scaled[large] < 1
+            column = np.where(large_is_small, large, small)
+            donor = large - large_is_small
+            probability = scaled[column]
+            thresholds[column] = probability
+            aliases[column] = donor
+            scaled[donor] -= 1 - probability
+            small += ~large_is_small
+            large = donor
+
+        self.width = width
+        self.thresholds = thresholds + np.tile(np.arange(width), rows)
+        self.targets = np.empty(rows * width * 2, dtype=np.int32)
+        self.targets[0::2] = targets * width
+        self.targets[1::2] = targets[aliases] * width
+        self.absorbing = np.zeros(rows * width, dtype=bool)
+        self.absorbing[::width] = absorbing
+
+    def walk(self, rows, rng, steps = None):
+        # Advances the walkers until every one is absorbed or after steps
+        # draws. Returns the rows and the number of draws.
+        taken = 0
+        while taken != steps and not self.absorbing[rows].all():
+            x = rng.random(len(rows))
+            x *= self.width
+            column = x.astype(np.int32)
+            column += rows
+            alias = x >= self.thresholds[column]
+            column <<= 1
+            column += alias
+            rows = self.targets[column]
+            taken += 1
+
+        return rows, taken
+
+
+class BatchSampler:
+    def __init__(self, compiled_fsm, max_steps = None):
+        # A ClockedFSM is sampled on its one-tick machine, and walkers that
+        # run out of ticks are invalid like at the end of an unrolled clock.
+        # max_steps does the same for machines with cycles.
+        self.max_steps = max_steps
+        if isinstance(compiled_fsm, ClockedFSM):
+            self.max_steps = compiled_fsm.ticks
+            compiled_fsm = compiled_fsm.step_fsm
+
+        self.compiled_fsm = compiled_fsm
+        self.offsets = np.frombuffer(compiled_fsm.offsets, dtype=np.int64).astype(np.int32)
+        self.targets = np.frombuffer(compiled_fsm.targets, dtype=np.int64).astype(np.int32)
+        self.final = np.frombuffer(bytes(compiled_fsm.final), dtype=np.uint8).astype(bool)
+        self.max_out_degree = int(np.diff(self.offsets).max(initial=0))
+
+        # Walkers carry their node in the Allen classifier's trie instead of
+        # a symbol list, the relation is read off the node at the end.
+        self.classifier = default_classifier
+        self.next_node = np.array(self.classifier.next_node, dtype=np.int32)
+        self.edge_digits = np.array(self.classifier.digits(compiled_fsm.symbols), dtype=np.int32)[
+            np.frombuffer(compiled_fsm.edge_symbols, dtype=np.int64)]
+
+        # Outcome of a walk: a relation, unclassified or invalid.
+        self.relations = list(dict.fromkeys(allen_mapping.values()))
+        self.unclassified = len(self.relations)
+        self.invalid = len(self.relations) + 1
+        relation_ids = {relation: i for i, relation in enumerate(self.relations)}
+        self.node_outcomes = np.array([relation_ids.get(relation, self.unclassified)
+                                       for relation in self.classifier.relations], dtype=np.int64)
+
+        # Small machines are sampled on the (state, node) chain with alias
+        # tables, larger ones on the compiled machine with its cumulative
+        # probabilities.
+        self.chain = self._build_chain()
+        self.step_table = None
+        if self.chain is not None:
+            self.step_table = _AliasTable(*self.chain)
+            self.stride = 1
+            self.stride_table = self.step_table
+            self.walks = 0
+        else:
+            self.cumulative = np.frombuffer(compiled_fsm.cumulative, dtype=np.float64)
+
+            # Edge keys are state_id + cumulative probability, so one
+            # searchsorted over all edges picks the next edge of every walker
+            # at once.
+            edge_states = np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))
+            self.edge_keys = edge_states + self.cumulative
+
+    def _build_stride_table(self):
+        # Table for `stride` steps per draw, the products of the one-step
+        # moves. Final and dead rows are absorbing, so taking several steps
+        # past them changes nothing.
+        probabilities, targets, absorbing = self.chain
+        step_probabilities, step_targets = probabilities, targets
+        stride = 1
+        while (stride < _MAX_STRIDE and step_targets.size * targets.shape[1] <= _MAX_TABLE_SIZE
+               and step_targets.shape[1] * targets.shape[1] <= _MAX_ALIAS_WIDTH):
+            step_probabilities, step_targets = _merge_columns(
+                step_probabilities[:, :, None] * probabilities[step_targets], targets[step_targets])
+            stride += 1
+
+        if stride > 1:
+            self.stride = stride
+            self.stride_table = _AliasTable(step_probabilities, step_targets, absorbing)
+        self.chain = None
+
+    def _build_chain(self):
+        # The rows of the chain are the (state, node) pairs reachable from
+        # the start, found breadth first, so the node moves with the state
+        # in one table lookup per step. None if the chain would be larger
+        # than _MAX_CHAIN_SIZE, which is given up on as soon as it shows.
+        compiled_fsm = self.compiled_fsm
+        offsets = np.frombuffer(compiled_fsm.offsets, dtype=np.int64)
+        degrees = np.diff(offsets)
+        max_degree = max(self.max_out_degree, 1)
+        if len(degrees) * max_degree > _MAX_CHAIN_SIZE:
+            return None
+
+        final = self.final
+        next_node = self.next_node.astype(np.int64)
+        width = self.classifier.width
+        nodes = len(self.classifier.relations)
+
+        # A padding edge after the last one, for rows with fewer edges than
+        # the widest.
+        edge_count = len(compiled_fsm.targets)
+        edge_targets = np.append(np.frombuffer(compiled_fsm.targets, dtype=np.int64), 0)
+        edge_probabilities = np.append(np.frombuffer(compiled_fsm.probabilities, dtype=np.float64), 0.0)
+        edge_digits = np.append(np.array(self.classifier.digits(compiled_fsm.symbols), dtype=np.int64)[
+            np.frombuffer(compiled_fsm.edge_symbols, dtype=np.int64)], 0)
+        sum_of_prob = np.bincount(np.repeat(np.arange(len(degrees)), degrees),
+                                  weights=edge_probabilities[:edge_count], minlength=len(degrees))
+        moving = ~final & (sum_of_prob > 0)
+
+        start = compiled_fsm.start * nodes + self.classifier.ROOT
+        seen = np.zeros(len(degrees) * nodes, dtype=bool)
+        seen[start] = True
+        frontier = np.array([start])
+        levels = [frontier]
+        row_count = 1
+        while len(frontier) > 0:
+            state, node = frontier // nodes, frontier % nodes
+            state, node = state[moving[state]], node[moving[state]]
+            count = degrees[state]
+            edge = np.repeat(offsets[state] - np.cumsum(count) + count, count) + np.arange(count.sum())
+            joint = edge_targets[edge] * nodes + next_node[np.repeat(node, count) * width + edge_digits[edge]]
+            joint = np.unique(joint)
+            frontier = joint[~seen[joint]]
+            seen[frontier] = True
+            levels.append(frontier)
+            row_count += len(frontier)
+            if row_count * max_degree > _MAX_CHAIN_SIZE:
+                return None
+
+        joint = np.concatenate(levels)
+        row_of = np.full(len(seen), -1, dtype=np.int64)
+        row_of[joint] = np.arange(len(joint))
+        state, node = joint // nodes, joint % nodes
+
+        probabilities = np.zeros((len(joint), max_degree))
+        targets = np.repeat(np.arange(len(joint))[:, None], max_degree, axis=1)
+        for k in range(max_degree):
+            has_edge = k < degrees[state]
+            edge = np.where(has_edge, offsets[state] + k, edge_count)
+            probabilities[:, k] = edge_probabilities[edge]
+            next_joint = edge_targets[edge] * nodes + next_node[node * width + edge_digits[edge]]
+            targets[:, k] = np.where(has_edge, row_of[next_joint], targets[:, k])
+
+        absorbing = ~moving[state]
+        probabilities[absorbing] = 0.0
+        probabilities[absorbing, 0] = 1.0
+        targets[absorbing] = np.arange(len(joint))[absorbing, None]
+        probabilities /= probabilities.sum(axis=1, keepdims=True)
+
+        # What a walker that stops in a row counts as: the relation of its
+        # node in a final state, invalid anywhere else.
+        self.outcomes = np.where(final[state], self.node_outcomes[node], self.invalid)
+        self.start = int(row_of[start])
+
+        return probabilities, targets, absorbing
+
+    def sample_rows(self, trials, rng):
+        # Rows of the chain the walkers stop in, for machines with a chain.
+        # The stride table is built once the walks sampled so far outnumber
+        # the entries of the one-step table, so that a few walks on a large
+        # machine don't pay for it.
+        self.walks += trials
+        if self.chain is not None and self.walks >= len(self.step_table.thresholds):
+            self._build_stride_table()
+
+        table = self.stride_table
+        rows = np.full(trials, self.start * table.width, dtype=np.int32)
+        rows, taken = table.walk(rows, rng, None if self.max_steps is None else self.max_steps // self.stride)
+        steps = taken * self.stride
+
+        # The steps of max_steps that don't make a whole stride.
+        if self.max_steps is not None and self.max_steps % self.stride > 0:
+            rows //= table.width
+            table = self.step_table
+            rows *= table.width
+            rows, taken = table.walk(rows, rng, self.max_steps % self.stride)
+            steps += taken
+
+        stats.observe("batch.steps", steps)
+        return rows // table.width
+
+    def allen_count(self, trials, seed = None, batch_size = 100000, rng = None):
+        if rng is None:
+            rng = np.random.default_rng(seed)
+
+        counts = {}
+        done = 0
+        while done < trials:
+            batch = min(batch_size, trials - done)
+            self.sample_counts(batch, rng, counts)
+            done += batch
+
+        return counts
+
+    def _pick_edges(self, state, begin, end, random_numbers):
+        if self.max_out_degree > _LINEAR_SCAN_MAX_DEGREE:
+            edge = np.searchsorted(self.edge_keys, state + random_numbers, side="left")
+            return np.minimum(np.maximum(edge, begin), end - 1)
+
+        # For small out-degrees counting the cumulative probabilities below
+        # the draw is cheaper than a binary search over all edges.
+        edge = begin.copy()
+        last = end - 1
+        for j in range(self.max_out_degree - 1):
+            candidate = np.minimum(begin + j, last)
+            edge += (candidate < last) & (self.cumulative[candidate] < random_numbers)
+        return edge
+
+    def sample_nodes(self, trials, rng):
+        # Classifier nodes the walkers on the compiled machine end in,
+        # _INVALID for walks that don't reach a final state.
+        nodes = np.full(trials, _INVALID, dtype=np.int32)
+
+        walking = np.arange(trials, dtype=np.int32)
+        state = np.full(trials, self.compiled_fsm.start, dtype=np.int32)
+        node = np.full(trials, self.classifier.ROOT, dtype=np.int32)
+
+        done = self.final[state]
+        steps = 0
+        while len(walking) > 0:
+            if done.any():
+                nodes[walking[done]] = node[done]
+                walking, state, node = walking[~done], state[~done], node[~done]
+
+            if len(walking) == 0 or steps == self.max_steps:
+                break
+
+            begin = self.offsets[state]
+            end = self.offsets[state + 1]
+
+            # Walkers stuck in a non-final state without transitions are
+            # invalid and keep the _INVALID node.
+            dead = begin == end
+            if dead.any():
+                walking, state, node = walking[~dead], state[~dead], node[~dead]
+                begin, end = begin[~dead], end[~dead]
+
+            edge = self._pick_edges(state, begin, end, rng.random(len(walking)))
+            node = self.next_node[node * self.classifier.width + self.edge_digits[edge]]
+
+            state = self.targets[edge]
+            done = self.final[state]
+            steps += 1
+
+        stats.observe("batch.steps", steps)
+
+        return nodes
+
+    def sample_outcomes(self, trials, rng):
+        # Number of walks per outcome (relation, unclassified, invalid).
+        outcome_count = len(self.relations) + 2
+        if self.step_table is None:
+            nodes = self.sample_nodes(trials, rng)
+            outcomes = np.where(nodes == _INVALID, self.invalid, self.node_outcomes[nodes])
+            return np.bincount(outcomes, minlength=outcome_count)
+
+        outcome_counts = np.zeros(outcome_count, dtype=np.int64)
+        for begin in range(0, trials, _CHUNK_SIZE):
+            rows = self.sample_rows(min(_CHUNK_SIZE, trials - begin), rng)
+            outcome_counts += np.bincount(self.outcomes[rows], minlength=outcome_count)
+        return outcome_counts
+
+    def sample_counts(self, trials, rng, counts):
+        # Adds the relation counts of `trials` walks to counts and returns
+        # the number of invalid walks among them.
+        with stats.timer("sampling"):
+            outcome_counts = self.sample_outcomes(trials, rng)
+
+        for relation, count in zip(self.relations, outcome_counts.tolist()):
+            if count > 0:
+                counts[relation] = counts.get(relation, 0) + count
+
+        invalid = int(outcome_counts[self.invalid])
+        stats.count("batch.walks", trials)
+        stats.count("batch.invalid_walks", invalid)
+        return invalid
+
+
+def sampler_for(compiled_fsm):
+    # A LazyProduct samples its own walks, everything else goes through a
+    # BatchSampler.
+    if isinstance(compiled_fsm, LazyProduct):
+        return compiled_fsm
+    return BatchSampler(compiled_fsm)
+
+
+def batch_allen_count(compiled_fsm, trials, seed = None, batch_size = 100000):
+    return sampler_for(compiled_fsm).allen_count(trials, seed, batch_size)
+
+
+def merge_allen_counts(all_counts):
+    counts = {}
+    for worker_counts in all_counts:
+        for key, count in worker_counts.items():
+            counts[key] = counts.get(key, 0) + count
+
+    return counts
+
+
+def _allen_count_worker(compiled_fsm, trials, seed_sequence, batch_size):
+    rng = np.random.default_rng(seed_sequence)
+    return sampler_for(compiled_fsm).allen_count(trials, batch_size=batch_size, rng=rng)
+
+
+def parallel_allen_count(compiled_fsm, trials, seed = None, workers = None, batch_size = 100000):
+    # Each worker gets its own child of one SeedSequence and a fixed share of
+    # the trials, so the merged counts only depend on seed and worker count.
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    seed_sequences = np.random.SeedSequence(seed).spawn(workers)
+    shares = [trials // workers + (1 if i < trials % workers else 0) for i in range(workers)]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        all_counts = pool.map(_allen_count_worker, repeat(compiled_fsm), shares,
+                              seed_sequences, repeat(batch_size))
+        return merge_allen_counts(all_counts)
+
+
+class MonteCarloResult:
+    def __init__(self, counts, trials, invalid, confidence, intervals, converged, elapsed):
+        self.counts = counts
+        self.trials = trials
+        self.invalid = invalid
+        self.confidence = confidence
+        self.intervals = intervals
+        self.converged = converged
+        self.elapsed = elapsed
+
+    def probabilities(self):
+        return {relation: count / self.trials for relation, count in self.counts.items()}
+
+    def max_half_width(self):
+        return max((high - low) / 2 for low, high in self.intervals.values())
+
+    def to_dict(self):
+        return {
+            "counts": dict(self.counts),
+            "trials": self.trials,
+            "invalid": self.invalid,
+            "confidence": self.confidence,
+            "intervals": {relation: list(interval) for relation, interval in self.intervals.items()},
+            "converged": self.converged,
+            "elapsed": self.elapsed,
+        }
+
+
+def wilson_interval(count, trials, z):
+    if trials == 0:
+        return (0.0, 1.0)
+
+    p = count / trials
+    denominator = 1 + z * z / trials
+    centre = (p + z * z / (2 * trials)) / denominator
+    half_width = z * ((p * (1 - p) + z * z / (4 * trials)) / trials) ** 0.5 / denominator
+    return (max(0.0, centre - half_width), min(1.0, centre + half_width))
+
+
+def adaptive_allen_count(compiled_fsm, precision = 0.001, confidence = 0.95, batch_size = 10000,
+                         max_trials = 10000000, time_budget = None, seed = None):
+    # Samples in batches until the Wilson interval of every relation's per
+    # trial probability is within +-precision, max_trials is reached or
+    # time_budget seconds have passed.
+    sampler = sampler_for(compiled_fsm)
+    rng = np.random.default_rng(seed)
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    relations = list(dict.fromkeys(allen_mapping.values()))
+    started = time.perf_counter()
+
+    counts = {}
+    trials = 0
+    invalid = 0
+    converged = False
+    while trials < max_trials:
+        batch = min(batch_size, max_trials - trials)
+        invalid += sampler.sample_counts(batch, rng, counts)
+        trials += batch
+
+        intervals = {relation: wilson_interval(counts.get(relation, 0), trials, z) for relation in relations}
+        if max((high - low) / 2 for low, high in intervals.values()) <= precision:
+            converged = True
+            break
+        if time_budget is not None and time.perf_counter() - started >= time_budget:
+            break
+
+    intervals = {relation: wilson_interval(counts.get(relation, 0), trials, z) for relation in relations}
+    return MonteCarloResult(counts, trials, invalid, confidence, intervals, converged,
+                            time.perf_counter() - started)
@@ -0,0 +1,173 @@
+import os
+import numpy as np
+
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product, repeat
+
+from .allen import allen_mapping
+from .clock import ClockedFSM
+from .compiled import CompiledFSM
+from .exact import exact_walk_outcomes
+from .instrumentation import stats
+from .product import explore_product, is_product_final, product_choices
+from .sampling import BatchSampler
+
+
+class ParameterSweep:
+    # Clock composed product of interval FSMs, built once with every edge
+    # probability kept as a formula over the transition probabilities of the
+    # components (la, ra, lb, ...). A grid point only rebinds the probability
+    # array of the one-tick machine, and the clock length is only the number
+    # of ticks, so neither needs a new product.
+    def __init__(self, interval_fsms):
+        fsms = list(interval_fsms)
+
+        # Parameters are the component symbols, defaulting to the
+        # probabilities the components were built with.
+        self.parameters = []
+        self.defaults = []
+        parameter_ids = {}
+        stay_ids = {}
+        self.stay_parameters = []
+        for i, fsm in enumerate(fsms):
+            for label, state in fsm.states.items():
+                outgoing = []
+                for symbol in state.transitions:
+                    if symbol not in parameter_ids:
+                        parameter_ids[symbol] = len(self.parameters)
+                        self.parameters.append(symbol)
+                        self.defaults.append(state.probabilities[symbol])
+                    outgoing.append(parameter_ids[symbol])
+
+                stay_ids[(i, label)] = len(self.stay_parameters)
+                self.stay_parameters.append(outgoing)
+
+        keys = []
+        key_ids = {}
+        symbol_ids = {}
+        self.symbols = []
+        self.offsets = array("q", [0])
+        self.targets = array("q")
+        self.edge_symbols = array("q")
+        self.edge_formulas = []
+
+        def key_id(key):
+            if key not in key_ids:
+                key_ids[key] = len(keys)
+                keys.append(key)
+            return key_ids[key]
+
+        def symbol_id(symbol):
+            if symbol not in symbol_ids:
+                symbol_ids[symbol] = len(self.symbols)
+                self.symbols.append(symbol)
+            return symbol_ids[symbol]
+
+        # Same one-tick machine as compile_clock_steps: 't' when every
+        # component stays, 'x,t' when the components in x move. A formula is
+        # the moved parameters and the stayed (component, state) pairs.
+        for key, choices in explore_product(fsms, False, product_choices):
+            key_id(key)
+            edges = [("t", key, ((), tuple(stay_ids[(i, label)] for i, label in enumerate(key))))]
+            for symbol, next_key, choice in choices:
+                moved, stayed = [], []
+                for i, option in enumerate(choice):
+                    if option[0] is None:
+                        stayed.append(stay_ids[(i, key[i])])
+                    else:
+                        moved.append(parameter_ids[option[0]])
+                edges.append((symbol + ",t", next_key, (tuple(moved), tuple(stayed))))
+
+            for symbol, next_key, formula in edges:
+                self.targets.append(key_id(next_key))
+                self.edge_symbols.append(symbol_id(symbol))
+                self.edge_formulas.append(formula)
+
+            # explore_product yields the keys in the order they are first
+            # seen, which is also the order key_id numbers them in.
+            self.offsets.append(len(self.targets))
+
+        self.labels = [",".join(key) for key in keys]
+        self.final = bytearray(1 if is_product_final(fsms, key) else 0 for key in keys)
+        self.parameter_ids = parameter_ids
+
+    def bind(self, values = None):
+        # One-tick machine with the parameters in values, the others keep
+        # their defaults.
+        p = list(self.defaults)
+        for symbol, value in (values or {}).items():
+            if symbol not in self.parameter_ids:
+                raise Exception("Unknown parameter: " + str(symbol))
+            p[self.parameter_ids[symbol]] = value
+
+        stay = [1 - sum(p[x] for x in outgoing) for outgoing in self.stay_parameters]
+        probabilities = array("d")
+        for moved, stayed in self.edge_formulas:
+            probability = 1.0
+            for x in moved:
+                probability *= p[x]
+            for x in stayed:
+                probability *= stay[x]
+            probabilities.append(probability)
+
+        return CompiledFSM(self.labels, self.symbols, 0, self.offsets, self.targets,
+                           self.edge_symbols, probabilities, self.final)
+
+    def evaluate(self, values, clock, method = "exact", trials = 100000, seed = None, conditional = False):
+        # Relation probabilities per trial (or over classified walks with
+        # conditional) and the invalid probability at one grid point.
+        clocked_fsm = ClockedFSM.from_step_fsm(self.bind(values), clock)
+
+        if method == "exact":
+            relations, invalid, _ = exact_walk_outcomes(clocked_fsm)
+        elif method == "monte_carlo":
+            counts = {}
+            invalid = BatchSampler(clocked_fsm).sample_counts(trials, np.random.default_rng(seed), counts)
+            relations = {relation: count / trials for relation, count in counts.items()}
+            invalid = invalid / trials
+        else:
+            raise Exception("Unknown sweep method: " + str(method))
+
+        if conditional:
+            total = sum(relations.values())
+            if total > 0:
+                relations = {relation: probability / total for relation, probability in relations.items()}
+
+        return relations, invalid
+
+    def run(self, grid, clocks, method = "exact", trials = 100000, seed = None, workers = None,
+            conditional = False):
+        # Evaluates every combination of the grid values (symbol -> list of
+        # probabilities) and clock lengths. Returns a tidy table: one row per
+        # grid point and relation.
+        names = list(grid)
+        points = [(dict(zip(names, values)), clock)
+                  for values in product(*(grid[name] for name in names)) for clock in clocks]
+
+        seeds = np.random.SeedSequence(seed).spawn(len(points)) if method == "monte_carlo" else [None] * len(points)
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        with stats.timer("sweep"):
+            if workers == 1 or len(points) == 1:
+                results = list(map(self.evaluate, [point[0] for point in points], [point[1] for point in points],
+                                   repeat(method), repeat(trials), seeds, repeat(conditional)))
+            else:
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    results = list(pool.map(_evaluate_point, repeat(self), points, repeat(method), repeat(trials),
+                                            seeds, repeat(conditional),
+                                            chunksize=max(1, len(points) // (workers * 4))))
+
+        relations = list(dict.fromkeys(allen_mapping.values()))
+        rows = []
+        for (values, clock), (probabilities, invalid) in zip(points, results):
+            for relation in relations:
+                rows.append(dict(values, clock=clock, relation=relation,
+                                 probability=probabilities.get(relation, 0.0), invalid=invalid))
+
+        return rows
+
+
+def _evaluate_point(sweep, point, method, trials, seed, conditional):
+    return sweep.evaluate(point[0], point[1], method, trials, seed, conditional)
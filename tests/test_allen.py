@@ -0,0 +1,49 @@
+import random
+
+import pytest
+
+from fsm.allen import allen_mapping, allowed_allen_transitions, compute_allen_count, default_classifier, depad
+
+# Symbols a product can put on its edges: Allen symbols, clocked ones,
+# bare ticks and symbols of other intervals or machines.
+SYMBOLS = allowed_allen_transitions + [symbol + ",t" for symbol in allowed_allen_transitions] + [
+    "t", "x", "y,t", "lc", "lc,t", "la,lc", "rb,rc,t", "st", "",
+]
+
+
+def baseline_relation(path):
+    # The lookup the classifier replaced.
+    return allen_mapping.get("_".join(depad(path)))
+
+
+def baseline_allen_count(paths):
+    counts = {}
+    for path in paths:
+        key = baseline_relation(path)
+        if key is not None:
+            counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def random_path(rng):
+    # Half the paths spell a relation with padding in between, so most
+    # relations show up, the others are random symbols.
+    if rng.random() < 0.5:
+        path = []
+        for symbol in rng.choice(list(allen_mapping)).split("_"):
+            path.extend(rng.choice(["t", "x", "lc,t"]) for _ in range(rng.randint(0, 2)))
+            path.append(symbol + rng.choice(["", ",t"]))
+        return path
+
+    return [rng.choice(SYMBOLS) for _ in range(rng.randint(0, 8))]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_classifier_matches_the_depad_lookup(seed):
+    rng = random.Random(seed)
+    paths = [random_path(rng) for _ in range(2000)]
+
+    for path in paths:
+        assert default_classifier.classify(path) == baseline_relation(path)
+    assert compute_allen_count(paths) == baseline_allen_count(paths)
+    assert len(baseline_allen_count(paths)) == len(set(allen_mapping.values()))
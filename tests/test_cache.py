@@ -0,0 +1,30 @@
+from fsm import FSM, get_clock_fsm, get_interval_fsm
+from fsm.cache import LRUCache, fingerprint
+
+
+def test_modifying_a_cached_product_leaves_the_cache_alone():
+    fsms = [get_interval_fsm("a"), get_interval_fsm("b")]
+    product = FSM.superpose_many(fsms, clock=get_clock_fsm(5))
+    expected = fingerprint(product)
+
+    product.add_transition(product.start.label, product.start.label, "loop", 1.0)
+    again = FSM.superpose_many(fsms, clock=get_clock_fsm(5))
+
+    assert again is not product
+    assert fingerprint(again) == expected
+    assert again.name == product.name
+    assert list(again.states) == list(product.states)
+
+
+def test_cache_is_bounded_by_the_size_of_its_values():
+    cache = LRUCache(10, len)
+    cache.put("a", "xxxx")
+    cache.put("b", "xxxx")
+    cache.put("c", "xxxx")
+
+    assert cache.get("a") is None
+    assert cache.size == 8
+
+    cache.put("d", "x" * 11)
+    assert cache.get("d") is None
+    assert cache.size == 8
@@ -0,0 +1,34 @@
+import pickle
+
+import pytest
+
+from fsm import FSM, CompiledFSM, get_clock_fsm, get_interval_fsm
+from fsm.sampling import parallel_allen_count
+
+
+@pytest.fixture
+def compiled_fsm():
+    clocked_fsm = FSM.superpose_many([get_interval_fsm("a"), get_interval_fsm("b")], clock=get_clock_fsm(8))
+    return clocked_fsm.compile()
+
+
+@pytest.mark.parametrize("use_mmap", [True, False])
+def test_loaded_machine_pickles(compiled_fsm, tmp_path, use_mmap):
+    path = str(tmp_path / "product.fsm")
+    compiled_fsm.save(path)
+    loaded = CompiledFSM.load(path, use_mmap=use_mmap)
+    copy = pickle.loads(pickle.dumps(loaded))
+
+    assert copy.labels == compiled_fsm.labels
+    assert list(copy.targets) == list(compiled_fsm.targets)
+    assert list(copy.probabilities) == list(compiled_fsm.probabilities)
+    assert bytes(copy.final) == bytes(compiled_fsm.final)
+
+
+def test_parallel_count_of_a_machine_read_without_mmap(compiled_fsm, tmp_path):
+    path = str(tmp_path / "product.fsm")
+    compiled_fsm.save(path)
+    loaded = CompiledFSM.load(path, use_mmap=False)
+
+    counts = parallel_allen_count(loaded, 20000, seed=1, workers=2, batch_size=5000)
+    assert counts == parallel_allen_count(compiled_fsm, 20000, seed=1, workers=2, batch_size=5000)
@@ -0,0 +1,63 @@
+import pytest
+
+from fsm import FSM, State, get_clock_fsm, get_interval_fsm
+from fsm.exact import exact_walk_outcomes
+
+
+def cyclic_fsm():
+    # a starts, then ends with probability 1/2 per step; 'y' leads into a
+    # trap that never reaches the final state.
+    fsm = FSM(State("s0"), "cyclic")
+    for label in ["s1", "s2", "s3"]:
+        fsm.add_state(State(label))
+    fsm.add_transition("s0", "s1", "la", 0.5)
+    fsm.add_transition("s0", "s3", "y", 0.5)
+    fsm.add_transition("s1", "s2", "ra", 0.5)
+    fsm.add_transition("s1", "s1", "x", 0.5)
+    fsm.add_transition("s3", "s3", "z", 1.0)
+    fsm.mark_state_as_final("s2")
+    return fsm
+
+
+def test_cycles_need_a_step_cap():
+    with pytest.raises(Exception, match="cycle"):
+        exact_walk_outcomes(cyclic_fsm())
+
+
+def test_mass_still_walking_after_the_cap_is_invalid():
+    settled = []
+    relations, invalid, unclassified = exact_walk_outcomes(cyclic_fsm(), 50, settled.append)
+
+    assert relations == {}
+    assert unclassified == pytest.approx(0.5 - 0.5 ** 50, abs=1e-12)
+    assert invalid == pytest.approx(0.5 + 0.5 ** 50, abs=1e-12)
+    assert settled == sorted(settled)
+
+
+def stuck_interval():
+    # Like get_interval_fsm("c"), but 'y' leads to a state without
+    # transitions, where the interval stays until the clock runs out.
+    fsm = get_interval_fsm("c", 0.4, 0.6)
+    fsm.add_state(State("x_c"))
+    fsm.add_transition("u_c", "x_c", "y", 0.3)
+    return fsm
+
+
+@pytest.mark.parametrize("fsms, clock", [
+    ([get_interval_fsm("a"), get_interval_fsm("b")], 2),
+    ([get_interval_fsm("a", 0.3, 0.7), get_interval_fsm("b", 0.8, 0.1)], 6),
+    ([get_interval_fsm("a"), get_interval_fsm("b", 0.5, 0.0)], 5),
+    ([get_interval_fsm("a", 0.9, 0.9), stuck_interval()], 7),
+    ([get_interval_fsm("a"), get_interval_fsm("b"), stuck_interval()], 4),
+])
+def test_symbolic_clock_matches_the_unrolled_clock(fsms, clock):
+    relations, invalid, unclassified = exact_walk_outcomes(FSM.superpose_many(fsms).with_clock(clock))
+    expected_relations, expected_invalid, expected_unclassified = exact_walk_outcomes(
+        FSM.superpose_many(fsms, clock=get_clock_fsm(clock)))
+
+    assert expected_invalid > 0
+    assert invalid == pytest.approx(expected_invalid, abs=1e-12)
+    assert unclassified == pytest.approx(expected_unclassified, abs=1e-12)
+    # Relations without mass may be left out by either.
+    for relation in set(relations) | set(expected_relations):
+        assert relations.get(relation, 0.0) == pytest.approx(expected_relations.get(relation, 0.0), abs=1e-12)
@@ -0,0 +1,39 @@
+import pytest
+
+from fsm import FSM, get_clock_fsm, get_interval_fsm
+from fsm.exact import exact_allen_distribution, exact_walk_outcomes
+from fsm.lumping import lump
+
+
+def assert_same_outcomes(original, lumped):
+    relations, invalid, unclassified = exact_walk_outcomes(original)
+    lumped_relations, lumped_invalid, lumped_unclassified = exact_walk_outcomes(lumped)
+
+    assert lumped_invalid == pytest.approx(invalid, abs=1e-12)
+    assert lumped_unclassified == pytest.approx(unclassified, abs=1e-12)
+    for relation, probability in relations.items():
+        assert lumped_relations.get(relation, 0.0) == pytest.approx(probability, abs=1e-12)
+
+
+@pytest.mark.parametrize("interval_names, clock", [("ab", 12), ("ab", 100), ("abc", 20)])
+def test_lump_preserves_the_allen_distribution(interval_names, clock):
+    intervals = [get_interval_fsm(name) for name in interval_names]
+    compiled_fsm = FSM.superpose_many(intervals, clock=get_clock_fsm(clock)).compile()
+    lumped = lump(compiled_fsm)
+
+    assert lumped.state_count() < compiled_fsm.state_count()
+    assert_same_outcomes(compiled_fsm, lumped)
+
+
+def test_lump_drops_zero_probability_edges():
+    # With certain moves the stay edges have probability 0, they used to be
+    # copied into the quotient and close cycles there.
+    clocked_fsm = FSM.superpose_many([get_interval_fsm("a", 1.0, 1.0), get_interval_fsm("b")],
+                                     clock=get_clock_fsm(5))
+    lumped = clocked_fsm.lump()
+
+    assert all(probability > 0 for probability in lumped.compile().probabilities)
+    distribution = exact_allen_distribution(clocked_fsm)
+    for relation, probability in exact_allen_distribution(lumped).items():
+        assert probability == pytest.approx(distribution[relation], abs=1e-12)
+    assert_same_outcomes(clocked_fsm.compile(), lumped.compile())
@@ -0,0 +1,49 @@
+import pytest
+
+from fsm import FSM, State, get_clock_fsm, get_interval_fsm
+from fsm.exact import exact_walk_outcomes
+
+
+def assert_conditioned_equal(original, pruned):
+    relations, invalid, unclassified = exact_walk_outcomes(original)
+    pruned_relations, pruned_invalid, pruned_unclassified = exact_walk_outcomes(pruned)
+
+    assert pruned_invalid == pytest.approx(0.0, abs=1e-12)
+    for relation, probability in relations.items():
+        assert pruned_relations.get(relation, 0.0) == pytest.approx(probability / (1 - invalid), abs=1e-12)
+
+
+def test_pruned_matches_the_valid_walks_of_the_original():
+    clocked_fsm = FSM.superpose_many([get_interval_fsm("a"), get_interval_fsm("b")], clock=get_clock_fsm(12))
+    compiled_fsm = clocked_fsm.compile()
+    pruned = compiled_fsm.pruned()
+
+    assert pruned.state_count() < compiled_fsm.state_count()
+    assert_conditioned_equal(compiled_fsm, pruned)
+
+
+def test_pruned_with_zero_probability_edges():
+    # 'ra' never fires, so every walk is invalid although d_a is reachable.
+    clocked_fsm = FSM.superpose_many([get_interval_fsm("a", 0.5, 0.0), get_interval_fsm("b")],
+                                     clock=get_clock_fsm(5))
+    with pytest.raises(Exception, match="No final state is reachable"):
+        clocked_fsm.prune()
+
+    assert len(clocked_fsm.prune(conditional=False).states) > 0
+
+
+def test_pruned_drops_states_only_reachable_through_zero_probability_edges():
+    fsm = FSM(State("s"))
+    for label in ("x", "y", "f"):
+        fsm.add_state(State(label))
+    fsm.mark_state_as_final("f")
+    fsm.add_transition("s", "x", "la", 0.5)
+    fsm.add_transition("s", "y", "lb", 0.5)
+    fsm.add_transition("x", "f", "ra", 1.0)
+    fsm.add_transition("y", "f", "rb", 0.0)
+
+    compiled_fsm = fsm.compile()
+    pruned = compiled_fsm.pruned()
+
+    assert "y" not in pruned.labels
+    assert_conditioned_equal(compiled_fsm, pruned)
@@ -0,0 +1,109 @@
+import random
+import numpy as np
+import pytest
+
+from collections import Counter
+
+from fsm import FSM, State, adaptive_monte_carlo, get_clock_fsm, get_interval_fsm, monte_carlo
+from fsm import sampling
+from fsm.exact import exact_allen_distribution, exact_walk_outcomes
+from fsm.sampling import BatchSampler, parallel_allen_count
+
+
+def lazy_product():
+    return FSM.lazy_product([get_interval_fsm("a"), get_interval_fsm("b")], clock=get_clock_fsm(6))
+
+
+def cyclic_fsm():
+    fsm = FSM(State("s0"), "cyclic")
+    for label in ["s1", "s2", "s3"]:
+        fsm.add_state(State(label))
+    fsm.add_transition("s0", "s1", "la", 0.5)
+    fsm.add_transition("s0", "s3", "y", 0.5)
+    fsm.add_transition("s1", "s2", "ra", 0.5)
+    fsm.add_transition("s1", "s1", "x", 0.5)
+    fsm.add_transition("s3", "s3", "z", 1.0)
+    fsm.mark_state_as_final("s2")
+    return fsm
+
+
+@pytest.mark.parametrize("fsm, max_steps", [
+    (FSM.superpose_many([get_interval_fsm("a"), get_interval_fsm("b")], clock=get_clock_fsm(6)), None),
+    (FSM.superpose_many([get_interval_fsm("a", 0.3, 0.7), get_interval_fsm("b")]).with_clock(7), None),
+    (cyclic_fsm(), 7),
+])
+@pytest.mark.parametrize("use_chain", [True, False])
+def test_batch_sampler_matches_the_exact_distribution(fsm, max_steps, use_chain, monkeypatch):
+    # Without the chain the walkers run on the compiled machine.
+    if not use_chain:
+        monkeypatch.setattr(sampling, "_MAX_CHAIN_SIZE", 0)
+    trials = 200000
+    relations, invalid, _ = exact_walk_outcomes(fsm, max_steps)
+    counts = {}
+    sampler = BatchSampler(fsm.compile(), max_steps)
+    assert (sampler.step_table is not None) == use_chain
+    sampled_invalid = sampler.sample_counts(trials, np.random.default_rng(0), counts)
+
+    # Within 5 standard deviations of the exact probabilities.
+    for relation, probability in list(relations.items()) + [(None, invalid)]:
+        count = sampled_invalid if relation is None else counts.get(relation, 0)
+        assert abs(count / trials - probability) <= 5 * (probability * (1 - probability) / trials) ** 0.5 + 1e-12
+
+
+def test_adaptive_monte_carlo_of_a_lazy_product():
+    result = adaptive_monte_carlo(lazy_product(), precision=0.01, seed=3)
+    probabilities = result.probabilities()
+
+    assert result.converged
+    for relation, probability in exact_allen_distribution(lazy_product()).items():
+        assert probabilities.get(relation, 0.0) == pytest.approx(probability, abs=0.02)
+
+
+def test_parallel_count_of_a_lazy_product():
+    counts = parallel_allen_count(lazy_product(), 4000, seed=5, workers=2)
+
+    assert counts == parallel_allen_count(lazy_product(), 4000, seed=5, workers=2)
+    assert sum(counts.values()) <= 4000
+
+
+@pytest.mark.parametrize("fsm", [lazy_product(), FSM.superpose_many([get_interval_fsm("a"), get_interval_fsm("b")])
+                                 .with_clock(4)])
+def test_prune_without_a_built_product_raises(fsm):
+    with pytest.raises(Exception, match="prune needs a fully built product"):
+        monte_carlo(fsm, 100, prune=True)
+
+
+def fan_out_fsm(probabilities):
+    # One state with an edge per probability, each into its own final state.
+    fsm = FSM(State("s"), "fan_out")
+    for i, probability in enumerate(probabilities):
+        fsm.add_state(State("f" + str(i)))
+        fsm.mark_state_as_final("f" + str(i))
+        fsm.add_transition("s", "f" + str(i), "e" + str(i), probability)
+    return fsm
+
+
+@pytest.mark.parametrize("probabilities", [
+    [0.5, 0.0, 0.1, 0.25, 0.0, 0.15],
+    [0.0, 0.02, 0.6, 0.0, 0.18],
+])
+def test_alias_and_scan_backends_sample_the_same_edges(probabilities):
+    fsm = fan_out_fsm(probabilities)
+    trials = 100000
+    frequencies = {}
+    for backend in ["scan", "alias"]:
+        random.seed(7)
+        counts = Counter(fsm.simulate(backend)[0][0] for _ in range(trials))
+        frequencies[backend] = {symbol: count / trials for symbol, count in counts.items()}
+
+    # Edges without probability are never taken, the others within 5
+    # standard deviations of their share of the total.
+    total = sum(probabilities)
+    for backend, sampled in frequencies.items():
+        for i, probability in enumerate(probabilities):
+            p = probability / total
+            frequency = sampled.get("e" + str(i), 0.0)
+            if p == 0:
+                assert frequency == 0
+            else:
+                assert abs(frequency - p) <= 5 * (p * (1 - p) / trials) ** 0.5
@@ -0,0 +1,225 @@
+import random
+
+import pytest
+
+from fsm import FSM, State, get_clock_fsm, get_interval_fsm
+from fsm.fsm import superpose_cache
+
+
+class BaselineState:
+    def __init__(self, label):
+        self.label = label
+        self.transitions = {}
+        self.probabilities = {}
+
+    def add_transition(self, other, symbol, probability):
+        self.transitions[symbol] = other
+        self.probabilities[symbol] = probability
+
+
+class BaselineFSM:
+    # The original product construction, kept as the reference: a FIFO queue
+    # that expands every product state once per path reaching it, and
+    # add_state replacing states that already exist.
+    def __init__(self, start):
+        self.start = start
+        self.states = {}
+        self.final_states = set()
+        self.states[self.start.label] = self.start
+
+    def add_state(self, state):
+        self.states[state.label] = state
+
+    def mark_state_as_final(self, state_label):
+        self.final_states.add(state_label)
+
+    def add_transition(self, prev_state_label, next_state_label, symbol, probability):
+        self.states[prev_state_label].add_transition(self.states[next_state_label], symbol, probability)
+
+    def superpose(self, other, is_clock = False):
+        start_state = (BaselineState(self.start.label + "," + other.start.label), self.start.label, other.start.label)
+
+        super_fsm = BaselineFSM(start_state[0])
+
+        state_queue = []
+        state_queue.append(start_state)
+
+        while len(state_queue) > 0:
+            current_state = state_queue.pop(0)
+
+            fsm1_cur_state_label = current_state[1]
+            fsm2_cur_state_label = current_state[2]
+            super_fsm_label = current_state[0].label
+
+            if not is_clock:
+                for symbol, next_state in self.states[fsm1_cur_state_label].transitions.items():
+                    new_state = BaselineState(next_state.label + "," + fsm2_cur_state_label)
+                    super_fsm.add_state(new_state)
+
+                    if next_state.label in self.final_states and fsm2_cur_state_label in other.final_states:
+                        super_fsm.mark_state_as_final(new_state.label)
+
+                    probability_fsm1 = self.states[fsm1_cur_state_label].probabilities[symbol]
+                    probability_fsm2 = 1 - sum(
+                        [x[1] for x in other.states[fsm2_cur_state_label].probabilities.items()])
+                    probability = probability_fsm1 * probability_fsm2
+
+                    super_fsm.add_transition(
+                        super_fsm_label, new_state.label, symbol, probability)
+                    state_queue.append((new_state, next_state.label, fsm2_cur_state_label))
+
+            for symbol, next_state in other.states[fsm2_cur_state_label].transitions.items():
+                new_state = BaselineState(fsm1_cur_state_label + "," + next_state.label)
+                super_fsm.add_state(new_state)
+                if (is_clock and fsm1_cur_state_label in self.final_states):
+                    super_fsm.mark_state_as_final(new_state.label)
+                elif next_state.label in other.final_states and fsm1_cur_state_label in self.final_states:
+                    super_fsm.mark_state_as_final(new_state.label)
+
+                probability_fsm1 = 1 - sum(
+                    [x[1] for x in self.states[fsm1_cur_state_label].probabilities.items()])
+                probability_fsm2 = other.states[fsm2_cur_state_label].probabilities[symbol]
+                probability = probability_fsm1 * probability_fsm2
+
+                super_fsm.add_transition(super_fsm_label, new_state.label, symbol, probability)
+                state_queue.append((new_state, fsm1_cur_state_label, next_state.label))
+
+            for symbol_1, next_state_1 in self.states[fsm1_cur_state_label].transitions.items():
+                for symbol_2, next_state_2 in other.states[fsm2_cur_state_label].transitions.items():
+                    new_state = BaselineState(next_state_1.label + "," + next_state_2.label)
+                    super_fsm.add_state(new_state)
+                    if is_clock and next_state_1.label in self.final_states:
+                        super_fsm.mark_state_as_final(new_state.label)
+                    elif next_state_1.label in self.final_states and next_state_2.label in other.final_states:
+                        super_fsm.mark_state_as_final(new_state.label)
+
+                    probability_fsm1 = self.states[fsm1_cur_state_label].probabilities[symbol_1]
+                    probability_fsm2 = other.states[fsm2_cur_state_label].probabilities[symbol_2]
+                    probability = probability_fsm1 * probability_fsm2
+
+                    super_fsm.add_transition(
+                        super_fsm_label, new_state.label, symbol_1 + "," + symbol_2, probability)
+                    state_queue.append((new_state, next_state_1.label, next_state_2.label))
+
+        return super_fsm
+
+
+def to_baseline(fsm):
+    baseline = BaselineFSM(BaselineState(fsm.start.label))
+    for label in fsm.states:
+        if label != fsm.start.label:
+            baseline.add_state(BaselineState(label))
+    for label, state in fsm.states.items():
+        for symbol, next_state in state.transitions.items():
+            baseline.add_transition(label, next_state.label, symbol, state.probabilities[symbol])
+    for label in fsm.final_states:
+        baseline.mark_state_as_final(label)
+    return baseline
+
+
+def automaton(fsm):
+    # States, transitions with their probabilities and final states,
+    # regardless of the order they were added in.
+    transitions = {label: {symbol: (next_state.label, state.probabilities[symbol])
+                           for symbol, next_state in state.transitions.items()}
+                   for label, state in fsm.states.items()}
+    return fsm.start.label, transitions, fsm.final_states & set(fsm.states)
+
+
+def assert_same_automaton(product, baseline):
+    start, transitions, final_states = automaton(product)
+    baseline_start, baseline_transitions, baseline_final_states = automaton(baseline)
+
+    assert start == baseline_start
+    assert set(transitions) == set(baseline_transitions)
+    assert final_states == baseline_final_states
+    for label, moves in transitions.items():
+        assert set(moves) == set(baseline_transitions[label])
+        for symbol, (target, probability) in moves.items():
+            baseline_target, baseline_probability = baseline_transitions[label][symbol]
+            assert target == baseline_target
+            assert probability == pytest.approx(baseline_probability, rel=1e-12, abs=1e-15)
+
+
+def random_dag(rng, name, state_count):
+    # Edges only go to later states, with a probability left for staying.
+    fsm = FSM(State(name + "0"), name)
+    for i in range(1, state_count):
+        fsm.add_state(State(name + str(i)))
+
+    for i in range(state_count - 1):
+        targets = rng.sample(range(i + 1, state_count), rng.randint(1, min(3, state_count - i - 1)))
+        weights = [rng.random() for _ in targets]
+        total = sum(weights) / rng.uniform(0.3, 1.0)
+        for j, weight in zip(targets, weights):
+            fsm.add_transition(name + str(i), name + str(j), name + str(i) + "_" + str(j), weight / total)
+
+    fsm.mark_state_as_final(name + str(state_count - 1))
+    for i in rng.sample(range(state_count - 1), rng.randint(0, min(2, state_count - 1))):
+        fsm.mark_state_as_final(name + str(i))
+    return fsm
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_superpose_of_random_dags_matches_the_baseline(seed):
+    rng = random.Random(seed)
+    fsm_1 = random_dag(rng, "p", rng.randint(2, 6))
+    fsm_2 = random_dag(rng, "q", rng.randint(2, 6))
+
+    assert_same_automaton(fsm_1.superpose(fsm_2), to_baseline(fsm_1).superpose(to_baseline(fsm_2)))
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_clocked_random_dags_match_the_baseline(seed):
+    rng = random.Random(seed)
+    fsm_1 = random_dag(rng, "p", rng.randint(2, 5))
+    fsm_2 = random_dag(rng, "q", rng.randint(2, 5))
+    clock = get_clock_fsm(rng.randint(2, 6))
+
+    baseline = to_baseline(fsm_1).superpose(to_baseline(fsm_2)).superpose(to_baseline(clock), is_clock=True)
+    assert_same_automaton(fsm_1.superpose(fsm_2).superpose(clock, is_clock=True), baseline)
+
+
+@pytest.mark.parametrize("interval_count", [2, 3])
+@pytest.mark.parametrize("clock", [2, 5, 8])
+def test_interval_products_match_the_baseline(interval_count, clock):
+    fsms = [get_interval_fsm(name, 0.3 + 0.1 * i, 0.6 - 0.1 * i) for i, name in enumerate("abc"[:interval_count])]
+
+    baseline = to_baseline(fsms[0])
+    for fsm in fsms[1:]:
+        baseline = baseline.superpose(to_baseline(fsm))
+    assert_same_automaton(FSM.superpose_many(fsms), baseline)
+
+    baseline = baseline.superpose(to_baseline(get_clock_fsm(clock)), is_clock=True)
+    assert_same_automaton(FSM.superpose_many(fsms, clock=get_clock_fsm(clock)), baseline)
+
+
+
+class Cancelled(Exception):
+    pass
+
+
+def test_superpose_reports_the_explored_share():
+    intervals = FSM.superpose_many([get_interval_fsm("a"), get_interval_fsm("b")])
+    clock = get_clock_fsm(200)
+    superpose_cache.clear()
+    expected = intervals.superpose(clock, is_clock=True)
+    superpose_cache.clear()
+    reported = []
+    product = intervals.superpose(clock, is_clock=True, report=reported.append)
+
+    assert len(reported) > 1
+    assert reported == sorted(reported) and 0 <= reported[0] and reported[-1] <= 1
+    assert_same_automaton(product, expected)
+
+
+def test_superpose_stops_when_report_raises():
+    def cancel(progress):
+        if progress > 0:
+            raise Cancelled()
+
+    intervals = FSM.superpose_many([get_interval_fsm("a"), get_interval_fsm("b")])
+    superpose_cache.clear()
+    with pytest.raises(Cancelled):
+        intervals.superpose(get_clock_fsm(200), is_clock=True, report=cancel)
+    assert len(superpose_cache) == 0
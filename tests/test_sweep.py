@@ -0,0 +1,33 @@
+import pytest
+
+from fsm import FSM, get_clock_fsm, get_interval_fsm
+from fsm.exact import exact_walk_outcomes
+from fsm.sweep import ParameterSweep
+
+NAMES = "abc"
+
+
+def intervals(values, interval_count):
+    # The components a grid point stands for, built with its probabilities.
+    return [get_interval_fsm(name, values.get("l" + name, 0.5), values.get("r" + name, 0.5))
+            for name in NAMES[:interval_count]]
+
+
+@pytest.mark.parametrize("interval_count, values, clock", [
+    (2, {}, 5),
+    (2, {"la": 0.2}, 6),
+    (2, {"la": 0.9, "rb": 0.1}, 8),
+    (3, {}, 4),
+    (3, {"lb": 0.15, "rc": 0.7}, 5),
+])
+def test_evaluate_matches_the_unrolled_product(interval_count, values, clock):
+    sweep = ParameterSweep(intervals({}, interval_count))
+    relations, invalid = sweep.evaluate(values, clock)
+
+    unrolled = FSM.superpose_many(intervals(values, interval_count), clock=get_clock_fsm(clock))
+    expected_relations, expected_invalid, _ = exact_walk_outcomes(unrolled)
+
+    assert invalid == pytest.approx(expected_invalid, abs=1e-12)
+    assert set(relations) == set(expected_relations)
+    for relation, probability in expected_relations.items():
+        assert relations[relation] == pytest.approx(probability, abs=1e-12)